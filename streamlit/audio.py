@@ -1,25 +1,38 @@
+import time
+script_start = time.perf_counter() # start of this script run, for the import and first paint timings
+
 import streamlit as st
 from snowflake.snowpark.context import get_active_session
-from snowflake.cortex import Complete
-from snowflake.core import Root
-import _snowflake
-import snowflake.connector
-import requests
+import functools
+import hashlib
+import io
 import json
 import os
-from snowflake.snowpark import Session
+import random
+import re
+import shutil
+import sqlite3
+import subprocess
+import tempfile
+import threading
+import uuid
+import zlib
+from collections import OrderedDict, deque
+from concurrent.futures import Future, ThreadPoolExecutor
+from contextlib import contextmanager
+from streamlit.runtime.scriptrunner import add_script_run_ctx, get_script_run_ctx
+import numpy as np
 import pandas as pd
-import pypdfium2 as pdfium
+# Heavier clients (snowflake.core Root, snowflake.cortex Complete, pypdfium2, _snowflake) are
+# imported when their feature is first used, and the clients built from them are cached
 
 session = get_active_session()
-root = Root(session)
+import_time = time.perf_counter() - script_start
 
 # Set pandas option to display all column content 
 pd.set_option("max_colwidth", None)
 
 # Constants
-DATABASE = session.get_current_database()
-SCHEMA = session.get_current_schema()
 #STAGE = "RAW_DATA_2"
 STAGE = "RAW_DATA_TX"
 FILE = "DATA_PRODUCT/Call_Center_Member_Denormalized.yaml"
@@ -28,7 +41,86 @@ FILE = "DATA_PRODUCT/Call_Center_Member_Denormalized.yaml"
 num_chunks = 1 # number of chunks to retrieve from cortex search (FAQ docs)
 num_transcripts = 10 # number of transcripts to retrieve from cortex search (Call transcripts)
 #num_transcripts = 1
-slide_window = 3 # window of chat history to consider for each subsequent question
+num_segments = 20 # number of transcript segments to retrieve from the segment search service
+segment_search = True # search timestamped segments (CALL_CENTER_RECORDING_SEGMENT_SEARCH) instead of whole transcripts, when the service exists
+max_referenced_recordings = 3 # distinct call recordings kept from the retrieved transcripts
+search_return_scores = False # ask Cortex Search for confidence scores (needs the feature enabled in the account, searches fail without it)
+search_score_thresholds = { # hits scoring below these are dropped, per score type (other score types, e.g. the unbounded reranker score, and hits without a score are kept)
+    'confidence_score': 0.3,
+    'local': 0.3, # local index score, 0-1
+}
+local_search = False # answer searches from a local lexical index first, falling back to Cortex Search (bypasses semantic search for confident hits)
+local_search_dir = "/tmp/audio_app_search" # persisted local search indexes, one directory per search service
+local_search_sources = { # Cortex Search service -> (table, {hit column: table column}) the local index is built from
+    'CALL_CENTER_RECORDING_SEGMENT_SEARCH': ('CALL_RECORDINGS_SEGMENTS', {
+        'CHUNK': 'SEGMENT_TEXT', 'RELATIVE_PATH': 'AUDIO_FILE_NAME', 'START_SECONDS': 'START_SECONDS', 'END_SECONDS': 'END_SECONDS',
+    }),
+    'CALL_CENTER_RECORDING_SEARCH_TX2': ('CALL_RECORDINGS_TRANSCRIPT_TABLE_TX', {'CHUNK': 'TRANSCRIPT', 'RELATIVE_PATH': 'AUDIO_FILE_NAME'}),
+    'CALL_CENTER_FAQ_SEARCH': ('FAQ_DOCS_CHUNKS_TABLE', {'CHUNK': 'CHUNK', 'RELATIVE_PATH': 'RELATIVE_PATH'}),
+}
+local_search_dim = 256 # dimensions of the local hashed term vectors (lexical: words and character trigrams, not semantic embeddings)
+local_search_alpha = 0.5 # weight of BM25 against hashed term vector similarity in the local ranking and score
+local_search_max_documents = 200000 # source tables with more rows are not indexed locally (Cortex Search only)
+local_search_min_score = 0.55 # below this score of its best hit the local index defers to Cortex Search
+slide_window = 3 # window of chat history to consider for each subsequent question (when rolling_memory is off)
+rolling_memory = True # fold older messages into a running summary after each turn instead of a sliding window
+memory_verbatim_messages = 2 # most recent messages (the last exchange) kept verbatim in the chat history
+memory_summary_words = 150 # maximum length of the running conversation summary
+stage_index_ttl = 900 # seconds before the stage index is fully re-listed (picks up deleted files)
+stage_index_min_refresh = 30 # minimum seconds between incremental stage index refreshes on a lookup miss
+url_expiry_margin = 60 # seconds before expiry at which a cached presigned URL is re-signed
+stream_render_interval = 0.05 # minimum seconds between re-renders of a streamed answer
+intent_routing = False # classify each question (Recordings / FAQ / Data) and check for member violations
+context_token_budgets = { # tokens available for search context + chat history in the answer prompt, per model
+    'claude-3-5-sonnet': 8000,
+    'llama3-70b': 4000, # 8k context window
+    'mistral-large2': 8000,
+    'llama3.1-70b': 8000,
+}
+default_context_token_budget = 4000
+history_budget_share = 0.25 # maximum share of the context budget used by chat history
+passage_tokens = 120 # approximate size of the passages documents are trimmed to
+prompt_cache_max_entries = 5000 # LLM responses kept in memory for the cacheable (deterministic) prompt types
+prompt_cache_path = None # e.g. "/tmp/prompt_cache.sqlite" to persist cached LLM responses across restarts
+span_log_path = None # e.g. "/tmp/turn_spans.jsonl" to append the timing spans of every turn as JSON lines
+span_log_table = None # e.g. "CHAT_TURN_SPANS" to append the timing spans of every turn to a table
+turn_traces_kept = 20 # turns whose timing spans are kept in the session for the Debug sidebar
+turn_timings_kept = 100 # turns whose time to first token and generation time are kept in the session
+query_tag = { # Snowpark query tag, each turn adds its turn_id to the attributes
+    "origin": "sf_sit",
+    "name": "payer_call_center_assistant_v2",
+    "version": {"major": 1, "minor": 0},
+    "attributes": {"is_quickstart": 1, "source": "streamlit"},
+}
+prompt_cache_ttls = { # seconds a cached response stays valid, per prompt type
+    'intent': 24 * 3600,
+    'violation': 3600,
+    'summary': 3600,
+}
+media_cache_dir = "/tmp/audio_app_cache" # downloaded recordings and audio clips, shared by all sessions
+media_cache_max_bytes = 500 * 1024 * 1024 # least recently used files are evicted above this size
+clip_padding = 2.0 # seconds of audio kept before and after a referenced time range
+max_clips_per_recording = 3 # time ranges of a recording offered as clips
+document_cache_dir = "/tmp/audio_app_documents" # downloaded FAQ PDFs and their rendered preview pages
+document_cache_max_bytes = 200 * 1024 * 1024 # least recently used files are evicted above this size
+pdf_preview_pages = 2 # pages of a referenced PDF shown in its preview
+pdf_render_scale = 1.0
+analyst_max_rows = 10000 # rows fetched from the result of a Cortex Analyst SQL statement
+analyst_prompt_rows = 20 # result rows included in the prompt summarising the answer
+analyst_page_size = 100 # rows per page of the Resultset expander
+analyst_cache_max_responses = 500 # Cortex Analyst responses (generated SQL) cached by question
+analyst_cache_max_results = 50 # Cortex Analyst result sets cached by SQL text
+analyst_cache_ttl = 24 * 3600 # maximum age in seconds of a cached Analyst response or result set
+transient_status_codes = {429, 500, 502, 503, 504} # HTTP statuses of a failed Cortex call that are retried (throttling, server errors)
+missing_object_retry = 600 # seconds before an optional table or search service found missing (setup notebook not re-run) is tried again
+table_version_ttl = 60 # seconds a table's LAST_ALTERED is trusted before it is looked up again
+call_summary_table = "CALL_RECORDINGS_SUMMARY_TABLE" # per-call summaries built by the setup notebook; None to always use transcripts
+call_summary_context = True # default of the sidebar option putting call summaries in front of the retrieved transcript text
+call_summary_ttl = 3600 # seconds a recording's summary is cached
+member_lookup_table = "CALL_CENTER_MEMBER_LOOKUP" # one row per phone number (setup notebook); None to query the view per call
+member_index_ttl = 3600 # seconds before the member index is fully reloaded (drops removed phone numbers)
+member_index_refresh = 300 # seconds between incremental member index refreshes
+member_index_min_refresh = 30 # minimum seconds between incremental refreshes on a lookup miss
 
 def config_options():
     """
@@ -71,6 +163,10 @@ def config_options():
         st.session_state.pop('edited_subject', None)
         st.session_state.pop('edited_body', None)
         st.session_state.pop('trigger_action', None)
+        st.session_state.pop('turn_timings', None)
+        st.session_state.pop('turn_traces', None)
+        st.session_state.pop('message_references', None)
+        st.session_state.pop('message_results', None)
 
         st.sidebar.success("Conversation and selections have been reset.")
 
@@ -92,6 +188,8 @@ def config_options():
     #     "",
     #     key='user_email')
 
+    st.sidebar.checkbox('Stream responses', key='stream_response', value=True)
+    st.sidebar.checkbox('Use call summaries as context', key='call_summary_context', value=call_summary_context)
     st.sidebar.checkbox('Show prompt', key ='debug_prompt',value = False)
     st.sidebar.checkbox('Debug', key ='debug',value = False)
 
@@ -107,6 +205,9 @@ def config_options():
     st.session_state.setdefault('edited_subject', '')
     st.session_state.setdefault('edited_body', '')
     st.session_state.setdefault('trigger_action', False)
+    st.session_state.setdefault('turn_timings', [])
+    st.session_state.setdefault('message_references', {})
+    st.session_state.setdefault('message_results', {})
     # Add any additional setdefaults as necessary
 
     return clear_conversation
@@ -117,6 +218,9 @@ def init_messages(clear_conversation):
     """
     if clear_conversation or 'messages' not in st.session_state:
         st.session_state.messages = []
+        st.session_state.message_references = {}
+        st.session_state.message_results = {}
+        st.session_state.conversation_memory = ConversationMemory()
         st.session_state.suggestions = []
         st.session_state.active_suggestion = None
         st.session_state.pop('member_id', None)
@@ -128,6 +232,193 @@ def init_messages(clear_conversation):
         # Properly reset 'phone_number_initialized' by removing it
         st.session_state.pop('phone_number_initialized', None)
 
+class TurnTrace:
+    """
+    Timing spans of the phases of one chat turn, correlated by turn_id.
+    Spans can be recorded from the turn's worker threads.
+    """
+    def __init__(self, turn_id=None):
+        self.turn_id = turn_id or uuid.uuid4().hex[:16]
+        self.started_at = time.time()
+        self.spans = []
+        self._start = time.perf_counter()
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def span(self, phase, **attributes):
+        start = time.perf_counter()
+        ok = True
+        try:
+            yield
+        except BaseException:
+            ok = False
+            raise
+        finally:
+            end = time.perf_counter()
+            with self._lock:
+                self.spans.append({
+                    'turn_id': self.turn_id,
+                    'phase': phase,
+                    'offset_s': round(start - self._start, 4),
+                    'duration_s': round(end - start, 4),
+                    'thread': threading.current_thread().name,
+                    'ok': ok,
+                    **attributes,
+                })
+
+    def close(self):
+        """
+        Record the whole turn as a final 'turn' span and return a copy of the spans
+        """
+        with self._lock:
+            self.spans.append({
+                'turn_id': self.turn_id, 'phase': 'turn', 'offset_s': 0.0,
+                'duration_s': round(time.perf_counter() - self._start, 4),
+                'thread': threading.current_thread().name, 'ok': True,
+            })
+            return list(self.spans)
+
+def start_turn():
+    """
+    Start tracing a chat turn: later spans of this session are recorded under its turn_id,
+    which is also put in the Snowpark query tag so warehouse query history can be joined back
+    """
+    trace = TurnTrace()
+    st.session_state.turn_trace = trace
+    session.query_tag = json.dumps({
+        **query_tag,
+        "attributes": {**query_tag["attributes"], "turn_id": trace.turn_id},
+    })
+    return trace
+
+thread_trace = threading.local()  # trace pinned to a background thread, see run_in_trace()
+
+def run_in_trace(trace, fn, *args):
+    """
+    Run fn with the spans of the calling thread recorded in trace instead of the session's current turn,
+    for background work that can outlive the turn that started it
+    """
+    thread_trace.trace = trace
+    try:
+        return fn(*args)
+    finally:
+        del thread_trace.trace
+
+@contextmanager
+def trace_span(phase, **attributes):
+    """
+    Time the enclosed block as a phase of the current turn (no-op outside a turn)
+    """
+    trace = getattr(thread_trace, 'trace', None) or st.session_state.get('turn_trace')
+    if trace is None:
+        yield
+        return
+    with trace.span(phase, **attributes):
+        yield
+
+def traced(phase):
+    """
+    Decorator timing every call of a function as a phase of the current turn
+    """
+    def decorator(fn):
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            with trace_span(phase):
+                return fn(*args, **kwargs)
+        return wrapper
+    return decorator
+
+def finish_turn(trace):
+    """
+    Close a turn: keep its spans for the Debug sidebar and append them to
+    span_log_path / span_log_table when configured
+    """
+    st.session_state.turn_trace = None
+    log_spans(trace, trace.close())
+
+def log_spans(trace, spans):
+    """
+    Keep the spans of a trace for the Debug sidebar and append them to span_log_path / span_log_table
+    """
+    traces = st.session_state.setdefault('turn_traces', [])
+    traces.append((trace.turn_id, spans))
+    del traces[:-turn_traces_kept]
+
+    started_at = time.strftime("%Y-%m-%dT%H:%M:%S%z", time.localtime(trace.started_at))
+    rows = [{'started_at': started_at, **span} for span in spans]
+    try:
+        if span_log_path:
+            with open(span_log_path, "a") as f:
+                f.writelines(json.dumps(row, default=str) + "\n" for row in rows)
+        if span_log_table:
+            columns = ['started_at', 'turn_id', 'phase', 'offset_s', 'duration_s', 'thread', 'ok']
+            session.create_dataframe(
+                [[row.get(column) for column in columns] + [json.dumps(row, default=str)] for row in rows],
+                schema=[column.upper() for column in columns] + ['SPAN']
+            ).write.mode("append").save_as_table(span_log_table)
+    except Exception as e:
+        if st.session_state.debug:
+            st.sidebar.warning(f"Could not log the turn timing spans: {e}")
+
+def display_turn_spans():
+    """
+    Show the timing spans of the latest turns in the Debug sidebar
+    """
+    traces = st.session_state.get('turn_traces') or []
+    if traces:
+        with st.sidebar.expander("Turn timing spans"):
+            for turn_id, spans in reversed(traces[-3:]):
+                st.caption(f"Turn {turn_id}")
+                st.dataframe(pd.DataFrame(spans).drop(columns=['turn_id']))
+
+@st.cache_resource(show_spinner=False)
+def get_database_and_schema():
+    """
+    Current database and schema of the session, looked up once per app process
+    """
+    return session.get_current_database(), session.get_current_schema()
+
+@st.cache_resource(show_spinner=False)
+def get_root():
+    """
+    One snowflake.core Root shared by all sessions of this app process
+    """
+    from snowflake.core import Root
+    return Root(session)
+
+@st.cache_resource(show_spinner=False)
+def get_search_service(service_name):
+    """
+    Cortex Search service handle, resolved once per app process
+    """
+    database, schema = get_database_and_schema()
+    return get_root().databases[database].schemas[schema].cortex_search_services[service_name]
+
+def is_missing_object_error(e):
+    """
+    Whether e says a table or search service does not exist (or is not visible to this role):
+    SQL error 002003, or HTTP 404 from the Snowflake REST API
+    """
+    return getattr(e, 'sql_error_code', None) == 2003 or getattr(e, 'status', None) == 404
+
+@st.cache_resource(show_spinner=False)
+def get_missing_objects():
+    """
+    Optional tables and search services (built by newer versions of the setup notebook) found
+    missing, name -> monotonic time found, shared by all sessions of this app process
+    """
+    return {}
+
+def object_missing(name):
+    """
+    Whether name was found missing less than missing_object_retry seconds ago
+    """
+    found = get_missing_objects().get(name)
+    return found is not None and time.monotonic() - found < missing_object_retry
+
+def note_missing_object(name):
+    get_missing_objects()[name] = time.monotonic()
+
 def download_file_from_stage(relative_path: str) -> str:
     """
     Download a file (PDF, audio, etc.) from a Snowflake stage to a local temp directory.
@@ -135,16 +426,66 @@ def download_file_from_stage(relative_path: str) -> str:
     """
     local_dir = "/tmp/"  # or any temp directory
     #relative_path = relative_path.replace(r'call_recordings/', 'CALL_RECORDINGS/')
-    session.file.get(f"@{DATABASE}.{SCHEMA}.{STAGE}/{relative_path}", local_dir)
+    database, schema = get_database_and_schema()
+    session.file.get(f"@{database}.{schema}.{STAGE}/{relative_path}", local_dir)
     local_file_path = os.path.join(local_dir, os.path.basename(relative_path))
     return local_file_path
 
-def get_pdf(local_pdf_path: str) -> pdfium.PdfDocument:
+def get_pdf(local_pdf_path: str) -> "pdfium.PdfDocument":
     """
-    Cache the loaded PDF to avoid re-downloading and re-parsing on every run.
+    Open a local PDF. Only needed when preview pages are missing from the document cache,
+    see get_pdf_page_images().
     """
+    import pypdfium2 as pdfium
     return pdfium.PdfDocument(local_pdf_path)
 
+def render_pdf_pages(local_pdf_path, pages):
+    """
+    PNG bytes of the given pages of a local PDF (b"" past the last page). Call with pdf_render_lock held.
+    """
+    pdf_doc = get_pdf(local_pdf_path)
+    try:
+        pngs = {}
+        for n in pages:
+            pngs[n] = b""
+            if n < len(pdf_doc):
+                buffer = io.BytesIO()
+                pdf_doc[n].render(scale=pdf_render_scale).to_pil().save(buffer, format="PNG")
+                pngs[n] = buffer.getvalue()
+        return pngs
+    finally:
+        pdf_doc.close()
+
+def get_pdf_page_images(stage_path):
+    """
+    PNG files (or bytes) of the first pdf_preview_pages pages of a stage PDF.
+    Pages are rendered once per file version (stage path + MD5) and kept in the document cache;
+    the PDF itself is only downloaded, and opened, when a page is missing.
+    Files missing from the stage index have no version to key on, so they are rendered without caching.
+    """
+    md5 = get_stage_file_md5(get_stage_index('FAQ', 3600), stage_path)
+    if not md5:
+        database, schema = get_database_and_schema()
+        with tempfile.TemporaryDirectory() as local_dir:
+            session.file.get(f"@{database}.{schema}.{STAGE}/{stage_path}", local_dir)
+            with pdf_render_lock:  # pdfium is not thread-safe
+                pngs = render_pdf_pages(os.path.join(local_dir, os.path.basename(stage_path)), range(pdf_preview_pages))
+        return [png for png in pngs.values() if png]
+    cache = get_document_cache()
+    keys = [f"page|{stage_path}|{md5}|{n}|{pdf_render_scale}" for n in range(pdf_preview_pages)]
+    paths = [cache.get(key, ".png") for key in keys]
+    if None in paths:
+        with pdf_render_lock:  # pdfium is not thread-safe
+            paths = [cache.get(key, ".png") for key in keys]  # another session may have rendered them meanwhile
+            missing = [n for n, path in enumerate(paths) if path is None]
+            if missing:
+                pngs = render_pdf_pages(get_stage_file_copy(cache, stage_path, md5, ".pdf"), missing)
+                for n in missing:
+                    # past the last page an empty marker is cached, so the PDF is not reopened
+                    paths[n] = cache.put(keys[n], ".png", pngs[n])
+    return [path for path in paths if os.path.getsize(path) > 0]
+
+@traced('render_document')
 def display_file_with_scrollbar(relative_path: str, file_type: str = "pdf", unique_key: str = ""):
     """
     A generic function that displays either a PDF or an audio file,
@@ -152,29 +493,26 @@ def display_file_with_scrollbar(relative_path: str, file_type: str = "pdf", uniq
     
     file_type can be "pdf" or "audio".
     """
-    local_file_path = download_file_from_stage(relative_path)
-    if not os.path.exists(local_file_path):
-        st.error(f"Could not find the {file_type} at {local_file_path}.")
-        return
+    if file_type == "pdf":
+        # Pages come from the document cache, the stage is only read when they are missing
+        try:
+            page_images = get_pdf_page_images(relative_path)
+        except Exception as e:
+            st.error(f"Could not preview the {file_type} {relative_path}: {e}")
+            return
+    else:
+        local_file_path = download_file_from_stage(relative_path)
+        if not os.path.exists(local_file_path):
+            st.error(f"Could not find the {file_type} at {local_file_path}.")
+            return
 
     # Common UI wrapper
     with st.expander(f"Preview: {os.path.basename(relative_path)}", expanded=False):
         if file_type == "pdf":
-            # PDF rendering logic
-            pdf_doc = get_pdf(local_file_path)
-            total_pages = len(pdf_doc)
-
-            # Example approach: show first 2 pages
-            page_numbers = (1, min(2, total_pages))
-            start_page, end_page = page_numbers
-
             pdf_container = st.container(height = 300)
-            for page_number in range(start_page - 1, end_page):
-                page = pdf_doc[page_number]
-                bitmap = page.render(scale=1.0)
-                pil_image = bitmap.to_pil()
+            for page_image in page_images:
                 with pdf_container:
-                    st.image(pil_image, use_column_width=True)
+                    st.image(page_image, use_column_width=True)
 
         elif file_type == "audio":
             # Audio playback logic
@@ -184,106 +522,1167 @@ def display_file_with_scrollbar(relative_path: str, file_type: str = "pdf", uniq
         else:
             st.warning(f"File type '{file_type}' not supported for preview.")
 
-def execute_cortex_complete(prompt):
+def is_transient_error(error):
+    """
+    Whether a failed Cortex call is worth retrying: an HTTP status in transient_status_codes
+    (on the error or its response), a timeout or a dropped connection
+    """
+    import requests
+    if isinstance(error, (ConnectionError, TimeoutError, requests.ConnectionError, requests.Timeout)):
+        return True
+    for source in (error, getattr(error, 'response', None)):
+        for attribute in ('status', 'status_code'):
+            if getattr(source, attribute, None) in transient_status_codes:
+                return True
+    return False
+
+class PromptCache:
+    """
+    Bounded LRU cache of LLM responses keyed by model and a hash of the normalised prompt,
+    with a per-entry TTL. Optionally backed by a SQLite file so entries survive restarts;
+    its least recently used entries are evicted too, hits being written in batches on the next put.
+    """
+    def __init__(self, max_entries, path=None):
+        self.max_entries = max_entries
+        self._entries = OrderedDict()  # key -> (response, expires_at)
+        self._touched = {}  # key -> accessed_at of the hits not written to the SQLite file yet
+        self._lock = threading.Lock()
+        self._db = None
+        if path:
+            self._db = sqlite3.connect(path, check_same_thread=False)
+            self._db.execute(
+                "CREATE TABLE IF NOT EXISTS prompt_cache "
+                "(key TEXT PRIMARY KEY, response TEXT, expires_at REAL, accessed_at REAL)"
+            )
+            self._db.commit()
+
+    @staticmethod
+    def make_key(model, prompt):
+        normalized = re.sub(r'\s+', ' ', prompt).strip()
+        return hashlib.sha256(f"{model}\n{normalized}".encode('utf-8')).hexdigest()
+
+    def get(self, model, prompt):
+        key = self.make_key(model, prompt)
+        now = time.time()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None and self._db is not None:
+                row = self._db.execute(
+                    "SELECT response, expires_at FROM prompt_cache WHERE key = ?", (key,)
+                ).fetchone()
+                if row:
+                    entry = self._entries[key] = (row[0], row[1])
+            if entry is None:
+                return None
+            if entry[1] <= now:
+                self._entries.pop(key, None)
+                return None
+            self._entries.move_to_end(key)
+            self._evict()
+            if self._db is not None:
+                self._touched[key] = now
+            return entry[0]
+
+    def put(self, model, prompt, response, ttl):
+        key = self.make_key(model, prompt)
+        now = time.time()
+        with self._lock:
+            self._entries[key] = (response, now + ttl)
+            self._entries.move_to_end(key)
+            self._evict()
+            if self._db is not None:
+                self._touched.pop(key, None)
+                self._db.executemany(
+                    "UPDATE prompt_cache SET accessed_at = ? WHERE key = ?",
+                    [(accessed_at, touched) for touched, accessed_at in self._touched.items()]
+                )
+                self._touched.clear()
+                self._db.execute(
+                    "INSERT OR REPLACE INTO prompt_cache VALUES (?, ?, ?, ?)", (key, response, now + ttl, now)
+                )
+                self._db.execute("DELETE FROM prompt_cache WHERE expires_at <= ?", (now,))
+                self._db.execute(
+                    "DELETE FROM prompt_cache WHERE key NOT IN "
+                    "(SELECT key FROM prompt_cache ORDER BY accessed_at DESC LIMIT ?)", (self.max_entries,)
+                )
+                self._db.commit()
+
+    def _evict(self):
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+@st.cache_resource(show_spinner=False)
+def get_prompt_cache():
+    """
+    One PromptCache shared by all sessions of this app process
+    """
+    return PromptCache(prompt_cache_max_entries, prompt_cache_path)
+
+class CortexClient:
+    """
+    Single entry point for Cortex Complete, over either the REST API or the SQL function.
+
+    - Identical requests (same model, mode and prompt) already in flight are collapsed:
+      the later callers wait for and share the first caller's response (single-flight).
+    - Transient failures are retried with jittered exponential backoff.
+    - Every call is recorded with its model, mode, prompt size, latency and attempts.
+    - Callers can opt in to the prompt-response cache by passing a cache_type
+      (a key of prompt_cache_ttls); free-form answers should never pass one.
+    """
+    def __init__(self, cache=None, max_attempts=3, backoff=0.5, max_backoff=8.0, history=500):
+        self.cache = cache
+        self.max_attempts = max_attempts
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.calls = deque(maxlen=history)
+        self._inflight = {}  # (model, mode, prompt) -> Future of the leading call
+        self._lock = threading.Lock()
+
+    def _call(self, prompt, model, mode, stream=False):
+        if mode == 'API':
+            from snowflake.cortex import Complete
+            return Complete(model, prompt, session=session, stream=stream)
+        cmd = "SELECT snowflake.cortex.complete(?, ?) AS response"
+        response_txt = session.sql(cmd, params=[model, prompt]).collect()[0].RESPONSE
+        return iter([response_txt]) if stream else response_txt
+
+    def _sleep_before_retry(self, attempt):
+        time.sleep(random.uniform(0, min(self.max_backoff, self.backoff * 2 ** attempt)))
+
+    def _record(self, prompt, model, mode, start, **details):
+        ctx = get_script_run_ctx()
+        self.calls.append({
+            'session_id': ctx.session_id if ctx else None,
+            'model': model,
+            'mode': mode,
+            'prompt_chars': len(prompt),
+            'prompt_tokens_est': len(prompt) // 4,
+            'latency_s': round(time.perf_counter() - start, 3),
+            **details,
+        })
+
+    @traced('cortex_complete')
+    def complete(self, prompt, model, mode='API', cache_type=None):
+        """
+        Return the completion for prompt, sharing the result of an identical in-flight call
+        """
+        start = time.perf_counter()
+        if cache_type and self.cache is not None:
+            response_txt = self.cache.get(model, prompt)
+            if response_txt is not None:
+                self._record(prompt, model, mode, start, attempts=0, shared=False, ok=True, cached=True)
+                return response_txt
+
+        key = (model, mode, prompt)
+        with self._lock:
+            leader = self._inflight.get(key)
+            if leader is None:
+                future = self._inflight[key] = Future()
+        if leader is not None:
+            response_txt = leader.result()
+            self._record(prompt, model, mode, start, attempts=0, shared=True, ok=True)
+            return response_txt
+
+        attempt = 0
+        try:
+            while True:
+                attempt += 1
+                try:
+                    response_txt = self._call(prompt, model, mode)
+                    break
+                except Exception as e:
+                    if attempt >= self.max_attempts or not is_transient_error(e):
+                        raise
+                    self._sleep_before_retry(attempt)
+        except BaseException as e:
+            future.set_exception(e)
+            self._record(prompt, model, mode, start, attempts=attempt, shared=False, ok=False)
+            raise
+        else:
+            future.set_result(response_txt)
+        finally:
+            with self._lock:
+                self._inflight.pop(key, None)
+
+        details = {}
+        if cache_type and self.cache is not None:
+            try:
+                self.cache.put(model, prompt, response_txt, prompt_cache_ttls[cache_type])
+            except Exception as e:
+                # the response is still good, it is just not cached
+                details['cache_error'] = repr(e)
+        self._record(prompt, model, mode, start, attempts=attempt, shared=False, ok=True, **details)
+        return response_txt
+
+    def stream(self, prompt, model, mode='API'):
+        """
+        Yield the completion for prompt as it is generated.
+        Streams are not shared; transient failures are retried until the first token arrives.
+        """
+        start = time.perf_counter()
+        attempt = 0
+        with trace_span('cortex_complete_stream'):
+            while True:
+                attempt += 1
+                try:
+                    tokens = iter(self._call(prompt, model, mode, stream=True))
+                    first_token = next(tokens, None)
+                    break
+                except Exception as e:
+                    if attempt >= self.max_attempts or not is_transient_error(e):
+                        self._record(prompt, model, mode, start, attempts=attempt, shared=False, ok=False, stream=True)
+                        raise
+                    self._sleep_before_retry(attempt)
+            time_to_first_token = round(time.perf_counter() - start, 3)
+            if first_token is not None:
+                yield first_token
+                yield from tokens
+        self._record(prompt, model, mode, start, attempts=attempt, shared=False, ok=True,
+                     stream=True, time_to_first_token_s=time_to_first_token)
+
+@st.cache_resource(show_spinner=False)
+def get_cortex_client():
+    """
+    One CortexClient shared by all sessions of this app process
+    """
+    return CortexClient(cache=get_prompt_cache())
+
+def execute_cortex_complete(prompt, cache_type=None, restriction_prompt=None):
+    """
+    Execute Cortex Complete for prompts.
+    Pass cache_type (a key of prompt_cache_ttls) only for prompts with a deterministic short answer.
+    restriction_prompt defaults to the session's (the selected member, when restricted)
+    """
+    if restriction_prompt is None:
+        restriction_prompt = st.session_state.restriction_prompt
+    return get_cortex_client().complete(
+        f"""{prompt}.{restriction_prompt}""",
+        st.session_state.model_name,
+        st.session_state.cortex_complete_type,
+        cache_type=cache_type
+    )
+
+def stream_cortex_complete(prompt):
     """
-    Execute Cortex Complete for prompts
+    Execute Cortex Complete for prompts and yield the response as it is generated.
+    The REST API streams tokens; the SQL function only returns the full response,
+    which is yielded as a single chunk.
     """
-    if st.session_state.cortex_complete_type == 'API':
-       response_txt = execute_cortex_complete_api(f"""{prompt}.{st.session_state.restriction_prompt}""")
-    else:
-        response_txt = execute_cortex_complete_sql(f"""{prompt}.{st.session_state.restriction_prompt}""")
-    return response_txt
+    return get_cortex_client().stream(
+        f"""{prompt}.{st.session_state.restriction_prompt}""",
+        st.session_state.model_name,
+        st.session_state.cortex_complete_type
+    )
+
+@traced('render_stream')
+def render_stream(tokens, message_placeholder):
+    """
+    Render streamed tokens incrementally into message_placeholder.
+    Returns the full response text and the time to first token / total generation time in seconds
+    """
+    start = time.perf_counter()
+    first_token = None
+    last_render = 0.0
+    response_txt = ""
+    for token in tokens:
+        now = time.perf_counter()
+        if first_token is None:
+            first_token = now - start
+        response_txt += token
+        if now - last_render >= stream_render_interval:
+            message_placeholder.markdown(response_txt + "▌")
+            last_render = now
+    generation_time = time.perf_counter() - start
+    return response_txt, {
+        'time_to_first_token': first_token if first_token is not None else generation_time,
+        'generation_time': generation_time,
+    }
 
-def execute_cortex_complete_sql(prompt):
+def display_llm_call_stats():
     """
-    Execute Cortex Complete using the SQL API
+    Show the Cortex Complete calls made by this session in the Debug sidebar
     """
-    cmd = "SELECT snowflake.cortex.complete(?, ?) AS response"
-    df_response = session.sql(cmd, params=[st.session_state.model_name, prompt]).collect()
-    response_txt = df_response[0].RESPONSE
-    return response_txt
+    ctx = get_script_run_ctx()
+    session_id = ctx.session_id if ctx else None
+    calls = [call for call in list(get_cortex_client().calls) if call['session_id'] == session_id]
+    if calls:
+        with st.sidebar.expander("Cortex Complete calls"):
+            st.dataframe(pd.DataFrame(calls[-20:]).drop(columns=['session_id']))
 
-def execute_cortex_complete_api(prompt):    
+def normalize_stage_path(relative_path):
     """
-    Execute Cortex Complete using the REST API
+    Normalise a stage path so that 'CALL_RECORDINGS/x.mp3' (stage listing) and
+    'call_recordings/x.mp3' (search index) map to the same key
     """
-    response_txt = Complete(
-                    st.session_state.model_name,
-                    prompt,
-                    session=session
-                    )
+    folder, sep, name = relative_path.partition('/')
+    return f"{folder.lower()}{sep}{name}"
 
-    res = Complete( model=st.session_state.model_name,
-        prompt =prompt,
-        session=session)
+class StageIndex:
+    """
+    Process-wide index of the files under one stage folder.
 
-    return response_txt
+    The directory listing is cached and refreshed incrementally (only files modified
+    since the newest one already indexed) when a lookup misses, and fully re-listed
+    once stage_index_ttl has elapsed. Presigned URLs are only generated for the paths
+    a search returns and are reused until shortly before they expire.
+    """
+    def __init__(self, stage, folder, url_expiry):
+        self.stage = stage
+        self.folder = folder
+        self.url_expiry = url_expiry
+        self._files = {}  # normalised path -> stage file attributes
+        self._urls = {}   # stage path -> (presigned URL, monotonic time after which it is re-signed)
+        self._listed_at = None
+        self._checked_at = None
+        self._watermark = 0  # newest LAST_MODIFIED seen, in epoch milliseconds
+        self._lock = threading.Lock()
 
-@st.cache_data(show_spinner=False)
-def get_similar_transcripts_cortex_search(question):
+    def _list(self, files, since=0):
+        """
+        Add the folder's files modified at or after 'since' (epoch milliseconds) to files
+        and return the newest LAST_MODIFIED seen. The bound is inclusive so files landing in the
+        same millisecond as the previous newest one are not skipped; files are keyed by path,
+        so those listed again just replace their entry.
+        """
+        cmd = f"""
+            SELECT RELATIVE_PATH, SIZE, MD5, DATE_PART(EPOCH_MILLISECOND, LAST_MODIFIED) AS MODIFIED_MS
+            FROM directory(@{self.stage})
+            WHERE RELATIVE_PATH LIKE '%{self.folder}%'
+            AND DATE_PART(EPOCH_MILLISECOND, LAST_MODIFIED) >= ?
+        """
+        watermark = since
+        for row in session.sql(cmd, params=[since]).collect():
+            files[normalize_stage_path(row.RELATIVE_PATH)] = {
+                'RELATIVE_PATH': row.RELATIVE_PATH,
+                'SIZE': row.SIZE,
+                'MD5': row.MD5,
+                'MODIFIED_MS': row.MODIFIED_MS,
+            }
+            watermark = max(watermark, row.MODIFIED_MS)
+        return watermark
+
+    def refresh(self, full=False):
+        """
+        Re-list the whole folder when forced or when the TTL has expired,
+        otherwise only pick up files added or modified since the last listing
+        (at most once every stage_index_min_refresh seconds)
+        """
+        with self._lock:
+            now = time.monotonic()
+            if full or self._listed_at is None or now - self._listed_at > stage_index_ttl:
+                files = {}
+                self._watermark = self._list(files)
+                self._files = files
+                self._listed_at = self._checked_at = now
+            elif now - self._checked_at > stage_index_min_refresh:
+                self._watermark = self._list(self._files, since=self._watermark)
+                self._checked_at = now
+
+    def get_many(self, relative_paths):
+        """
+        Return {path: stage file attributes} for the (search or stage) paths found in the
+        stage, refreshing the index once if any of them is unknown or the TTL has expired
+        """
+        keys = {path: normalize_stage_path(path) for path in relative_paths}
+        if (self._listed_at is None
+                or time.monotonic() - self._listed_at > stage_index_ttl
+                or any(key not in self._files for key in keys.values())):
+            self.refresh()
+        files = self._files
+        return {path: files[key] for path, key in keys.items() if key in files}
+
+    def presign(self, stage_paths):
+        """
+        Return {stage path: presigned URL}, signing only paths without a fresh cached URL
+        """
+        with self._lock:
+            now = time.monotonic()
+            urls = {path: self._urls[path][0] for path in stage_paths
+                    if path in self._urls and self._urls[path][1] > now}
+            missing = [path for path in stage_paths if path not in urls]
+            if missing:
+                cmd = f"""
+                    SELECT RELATIVE_PATH, get_presigned_URL(@{self.stage}, RELATIVE_PATH, {self.url_expiry}) AS URL_LINK
+                    FROM directory(@{self.stage})
+                    WHERE RELATIVE_PATH IN ({', '.join('?' for _ in missing)})
+                """
+                signed_at = time.monotonic()
+                for row in session.sql(cmd, params=missing).collect():
+                    urls[row.RELATIVE_PATH] = row.URL_LINK
+                    self._urls[row.RELATIVE_PATH] = (row.URL_LINK, signed_at + self.url_expiry - url_expiry_margin)
+            return urls
+
+    @traced('presign_urls')
+    def referred_documents(self, relative_paths, presign=True):
+        """
+        Map search result paths to their stage paths and presigned URLs
+        (URL_LINK is None without presign, for references signed on demand)
+        """
+        stage_files = self.get_many(relative_paths)
+        stage_paths = []
+        for relative_path in relative_paths:
+            stage_file = stage_files.get(relative_path)
+            if stage_file and stage_file['RELATIVE_PATH'] not in stage_paths:
+                stage_paths.append(stage_file['RELATIVE_PATH'])
+        if not presign:
+            return pd.DataFrame([(path, None) for path in stage_paths], columns=['RELATIVE_PATH', 'URL_LINK'])
+        urls = self.presign(stage_paths)
+        return pd.DataFrame(
+            [(path, urls[path]) for path in stage_paths if path in urls],
+            columns=['RELATIVE_PATH', 'URL_LINK']
+        )
+
+@st.cache_resource(show_spinner=False)
+def get_stage_index(folder, url_expiry):
     """
-    Get similar call transcripts using Cortex Search and return them 
-    along with a presigned URL to access the files
+    One StageIndex per stage folder, shared by all sessions of this app process
+    """
+    return StageIndex(STAGE, folder, url_expiry)
+
+class DiskCache:
     """
-    response = (
-        root.databases[DATABASE]
-        .schemas[SCHEMA]
-        .cortex_search_services["CALL_CENTER_RECORDING_SEARCH_TX2"]
-        .search(
-            question,
-            ['CHUNK', 'RELATIVE_PATH'],
-            limit=num_transcripts,
-            # experimental={"returnConfidenceScores": True}
+    Directory of cached files shared by all sessions (and app processes) on this host.
+
+    Files are written under a temporary name and renamed into place, so readers never see
+    a partial file. Reads refresh a file's modification time, and once the directory grows
+    past max_bytes the least recently used files are deleted.
+    """
+    def __init__(self, directory, max_bytes):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self._lock = threading.RLock()  # re-entrant: creating a clip first fetches its recording
+        os.makedirs(directory, exist_ok=True)
+
+    def path(self, key, suffix=""):
+        return os.path.join(self.directory, hashlib.sha256(key.encode()).hexdigest()[:32] + suffix)
+
+    def get(self, key, suffix=""):
+        """
+        Return the path of a cached file, or None
+        """
+        path = self.path(key, suffix)
+        try:
+            os.utime(path)
+        except FileNotFoundError:
+            return None
+        return path
+
+    def put(self, key, suffix, data):
+        """
+        Store data (bytes) under key and return its path
+        """
+        path = self.path(key, suffix)
+        fd, tmp_path = tempfile.mkstemp(dir=self.directory, suffix=".tmp")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                f.write(data)
+            os.replace(tmp_path, path)
+        except BaseException:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+        self.evict(keep=path)
+        return path
+
+    def get_or_create(self, key, suffix, create):
+        """
+        Return the path of the cached file, creating its content with create() on a miss.
+        Concurrent misses in this process create it once.
+        """
+        path = self.get(key, suffix)
+        if path is None:
+            with self._lock:
+                path = self.get(key, suffix) or self.put(key, suffix, create())
+        return path
+
+    def evict(self, keep=None):
+        """
+        Delete the least recently used files until the directory fits in max_bytes
+        """
+        entries, total = [], 0
+        for entry in os.scandir(self.directory):
+            if entry.name.endswith(".tmp"):
+                continue
+            try:
+                stat = entry.stat()
+            except FileNotFoundError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, entry.path))
+            total += stat.st_size
+        for _, size, path in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            if path == keep:
+                continue
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            total -= size
+
+@st.cache_resource(show_spinner=False)
+def get_media_cache():
+    """
+    One DiskCache for downloaded recordings and audio clips, shared by all sessions of this app process
+    """
+    return DiskCache(media_cache_dir, media_cache_max_bytes)
+
+MP3_BITRATES = { # Layer III bitrates in kbps by bitrate index, for MPEG-1 and MPEG-2/2.5
+    3: [0, 32, 40, 48, 56, 64, 80, 96, 112, 128, 160, 192, 224, 256, 320],
+    2: [0, 8, 16, 24, 32, 40, 48, 56, 64, 80, 96, 112, 128, 144, 160],
+}
+MP3_SAMPLE_RATES = {3: [44100, 48000, 32000], 2: [22050, 24000, 16000], 0: [11025, 12000, 8000]}
+
+def mp3_frames(data):
+    """
+    Yield (offset, length, duration in seconds) of the MPEG Layer III frames in data,
+    skipping a leading ID3v2 tag, the Xing/Info header frame and any bytes between frames
+    """
+    offset = 0
+    if data[:3] == b"ID3" and len(data) >= 10:
+        offset = 10 + ((data[6] & 0x7f) << 21 | (data[7] & 0x7f) << 14 | (data[8] & 0x7f) << 7 | data[9] & 0x7f)
+    first = True
+    while offset + 4 <= len(data):
+        header = data[offset + 1]
+        version, layer = (header >> 3) & 3, (header >> 1) & 3
+        bitrate_index, rate_index = data[offset + 2] >> 4, (data[offset + 2] >> 2) & 3
+        if (data[offset] != 0xff or header & 0xe0 != 0xe0 or version == 1 or layer != 1
+                or bitrate_index in (0, 15) or rate_index == 3):
+            offset += 1  # not a frame header: resynchronise
+            continue
+        samples = 1152 if version == 3 else 576
+        sample_rate = MP3_SAMPLE_RATES[version][rate_index]
+        bitrate = MP3_BITRATES[3 if version == 3 else 2][bitrate_index] * 1000
+        length = samples // 8 * bitrate // sample_rate + ((data[offset + 2] >> 1) & 1)
+        head = data[offset:offset + 64]
+        if not (first and (b"Xing" in head or b"Info" in head)):
+            yield offset, length, samples / sample_rate
+        first = False
+        offset += length
+
+def cut_audio_clip(source_path, start, end):
+    """
+    Return the MP3 bytes of source_path between start and end seconds: with ffmpeg when it
+    is installed, otherwise by copying the MP3 frames of that range (no re-encoding)
+    """
+    if shutil.which("ffmpeg"):
+        result = subprocess.run(
+            ["ffmpeg", "-nostdin", "-v", "error", "-ss", f"{start:.2f}", "-to", f"{end:.2f}", "-i", source_path,
+             "-c", "copy", "-f", "mp3", "-"],
+            capture_output=True
         )
+        if result.returncode == 0 and result.stdout:
+            return result.stdout
+    with open(source_path, "rb") as f:
+        data = f.read()
+    position, frames = 0.0, []
+    for offset, length, duration in mp3_frames(data):
+        if position + duration > start:
+            frames.append(data[offset:offset + length])
+        position += duration
+        if position >= end:
+            break
+    return b"".join(frames) or data
+
+@st.cache_resource(show_spinner=False)
+def get_document_cache():
+    """
+    One DiskCache for FAQ documents and their rendered pages, shared by all sessions of this app process
+    """
+    return DiskCache(document_cache_dir, document_cache_max_bytes)
+
+pdf_render_lock = threading.Lock()
+
+def get_stage_file_md5(stage_index, stage_path):
+    """
+    MD5 of a stage file from the stage index ("" if unknown), identifying the file version in cache keys
+    """
+    stage_file = stage_index.get_many([stage_path]).get(stage_path) or {}
+    return stage_file.get('MD5') or ""
+
+def get_stage_file_copy(cache, stage_path, md5, suffix):
+    """
+    Local copy of a stage file, downloaded once per file version (stage path + MD5) into cache
+    """
+    def download():
+        database, schema = get_database_and_schema()
+        with tempfile.TemporaryDirectory() as local_dir:
+            session.file.get(f"@{database}.{schema}.{STAGE}/{stage_path}", local_dir)
+            with open(os.path.join(local_dir, os.path.basename(stage_path)), "rb") as f:
+                return f.read()
+    return cache.get_or_create(f"stage_file|{stage_path}|{md5}", suffix, download)
+
+@traced('audio_clip')
+def get_recording_clip(stage_path, start, end):
+    """
+    Local MP3 clip of a stage recording between start and end seconds (plus clip_padding),
+    cut once and kept in the media cache
+    """
+    cache = get_media_cache()
+    md5 = get_stage_file_md5(get_stage_index('CALL_RECORDINGS', 360), stage_path)
+    start, end = max(0.0, start - clip_padding), end + clip_padding
+    return cache.get_or_create(
+        f"clip|{stage_path}|{md5}|{start:.2f}|{end:.2f}", ".mp3",
+        lambda: cut_audio_clip(get_stage_file_copy(cache, stage_path, md5, ".mp3"), start, end)
     )
-   
-    results = response.results
-    df_chunks = pd.DataFrame(results, columns=['CHUNK', 'RELATIVE_PATH'])
-    similar_chunks = ''.join(
-        f"""
-        ### 
-        Beginning of Document {i+1}
-        Document Name: {row['RELATIVE_PATH']}
-        Content: {row['CHUNK']}
-        End of Document {i+1}
-        ####
+
+def display_recording_references(references, key):
+    """
+    List the call recordings referred for an answer. A player is only created (and the
+    clip of the referenced time ranges cut, or the full recording presigned) when the
+    agent switches a reference on.
+    """
+    st.markdown("The following call recordings were referred for this answer:")
+    for i, reference in enumerate(references):
+        relative_path = reference['RELATIVE_PATH']
+        time_ranges = reference.get('TIME_RANGES') or []
+        label = f"Call Recording : {relative_path}"
+        if time_ranges:
+            label += " (" + ", ".join(f"{format_timestamp(start)}-{format_timestamp(end)}" for start, end in time_ranges) + ")"
+        if not st.toggle(label, key=f"reference_{key}_{i}"):
+            continue
+        if time_ranges:
+            for start, end in time_ranges[:max_clips_per_recording]:
+                st.audio(get_recording_clip(relative_path, start, end), format="audio/mpeg")
+        else:
+            url_link = get_stage_index('CALL_RECORDINGS', 360).presign([relative_path]).get(relative_path)
+            if url_link:
+                st.audio(url_link, format="audio/mpeg")
+
+def search_tokens(text):
+    """
+    Lower-cased content words of a text, in order and with repeats and with a plural 's' removed (the BM25 terms)
+    """
+    return [
+        term[:-1] if len(term) > 3 and term.endswith('s') and not term.endswith('ss') else term
+        for term in re.findall(r"[a-z0-9]+", str(text).lower()) if term not in STOPWORDS
+    ]
+
+def term_vectors(terms, dim):
+    """
+    Deterministic dense vectors of terms: each term and its character trigrams are feature-hashed
+    (CRC32) into dim signed buckets, so terms sharing a stem or differing by a typo get similar vectors
+    """
+    vectors = np.zeros((len(terms), dim), dtype=np.float32)
+    for row, term in enumerate(terms):
+        padded = f"<{term}>"
+        for feature in [term] + [f"#{padded[i:i + 3]}" for i in range(len(padded) - 2)]:
+            bucket = zlib.crc32(feature.encode())
+            vectors[row, bucket % dim] += 1.0 if bucket & 0x80000000 else -1.0
+    return vectors
+
+class HybridIndex:
+    """
+    Read-only hybrid retrieval index over a table of documents, persisted as files in a directory
+    and memory-mapped on open:
+        - a BM25 inverted index: term_offsets / posting_docs / posting_tfs arrays in CSR layout
+        - an (N, dim) float32 matrix of L2-normalised document vectors, the IDF-weighted sum of
+          the term_vectors() of their terms (sublinear term frequency). These are lexical, not
+          semantic: they only add tolerance for shared stems and typos on top of BM25
+        - the document columns: numbers as arrays, text as UTF-8 blobs with offsets
+    A query scores every document with BM25 and cosine similarity (vectorised over the arrays),
+    ranks them by local_search_alpha * BM25 / best BM25 + (1 - local_search_alpha) * cosine and
+    returns the top hits with an absolute SCORE in [0, 1]: the same mix, with the IDF-weighted share
+    of the query terms a document contains in place of the relative BM25.
+    Ranking and scores are deterministic (ties go to the earlier document).
+    """
+    k1 = 1.2
+    b = 0.75
+
+    def __init__(self, directory):
+        with open(os.path.join(directory, "meta.json")) as f:
+            self.meta = json.load(f)
+        with open(os.path.join(directory, "vocabulary.json")) as f:
+            self.vocabulary = {term: i for i, term in enumerate(json.load(f))}
+        arrays = {
+            name[:-len(".npy")]: np.load(os.path.join(directory, name), mmap_mode='r')
+            for name in os.listdir(directory) if name.endswith(".npy")
+        }
+        self.idf, self.term_offsets = arrays['idf'], arrays['term_offsets']
+        self.posting_docs, self.posting_tfs = arrays['posting_docs'], arrays['posting_tfs']
+        self.doc_lengths, self.embeddings = arrays['doc_lengths'], arrays['embeddings']
+        self.columns = {}
+        for column, kind in self.meta['columns'].items():
+            if kind == 'text':
+                blob = np.memmap(os.path.join(directory, f"{column}.bin"), dtype=np.uint8, mode='r') \
+                    if arrays[f"{column}.offsets"][-1] else np.zeros(0, dtype=np.uint8)  # np.memmap rejects empty files
+                self.columns[column] = (blob, arrays[f"{column}.offsets"])
+            else:
+                self.columns[column] = arrays[column]
+
+    @property
+    def version(self):
+        return self.meta['version']
+
+    @staticmethod
+    def build(directory, batches, version, dim):
         """
-        for i, row in df_chunks.iterrows()
-    ).replace("'", "")
+        Index documents into directory, replacing any index there. batches is an iterable of
+        DataFrames (e.g. to_pandas_batches()) whose CHUNK column is the searchable text; each is
+        indexed as it arrives, so only the vocabulary and the postings (12 bytes each) stay in
+        memory while document columns are appended to files and the vectors are a memory-mapped file.
+        The files are written next to the index and swapped in once complete.
+        """
+        staging = tempfile.mkdtemp(dir=os.path.dirname(directory), prefix=f".{os.path.basename(directory)}.")
+        vocabulary = {}
+        term_chunks, doc_chunks, tf_chunks, length_chunks = [], [], [], []
+        columns, text_files, text_offsets, number_chunks = {}, {}, {}, {}
+        documents = 0
+        try:
+            for batch in batches:
+                terms, docs, tfs = [], [], []
+                lengths = np.zeros(len(batch), dtype=np.float32)
+                for row, text in enumerate(batch['CHUNK']):
+                    tokens = search_tokens("" if pd.isna(text) else text)
+                    lengths[row] = len(tokens)
+                    counts = {}
+                    for token in tokens:
+                        counts[token] = counts.get(token, 0) + 1
+                    for term, tf in counts.items():
+                        terms.append(vocabulary.setdefault(term, len(vocabulary)))
+                        docs.append(documents + row)
+                        tfs.append(tf)
+                term_chunks.append(np.array(terms, dtype=np.int32))
+                doc_chunks.append(np.array(docs, dtype=np.int32))
+                tf_chunks.append(np.array(tfs, dtype=np.float32))
+                length_chunks.append(lengths)
+
+                for column in batch.columns:
+                    if column not in columns:
+                        columns[column] = 'number' if pd.api.types.is_numeric_dtype(batch[column]) else 'text'
+                        if columns[column] == 'text':
+                            text_files[column] = open(os.path.join(staging, f"{column}.bin"), "wb")
+                            text_offsets[column] = [np.zeros(1, dtype=np.int64)]
+                        else:
+                            number_chunks[column] = []
+                    if columns[column] == 'text':
+                        encoded = [b"" if pd.isna(value) else str(value).encode() for value in batch[column]]
+                        text_files[column].write(b"".join(encoded))
+                        sizes = np.array([len(value) for value in encoded], dtype=np.int64)
+                        text_offsets[column].append(text_offsets[column][-1][-1] + np.cumsum(sizes))
+                    else:
+                        number_chunks[column].append(batch[column].to_numpy(dtype=np.float64))
+                documents += len(batch)
+        except BaseException:
+            shutil.rmtree(staging, ignore_errors=True)
+            raise
+        finally:
+            for f in text_files.values():
+                f.close()
+
+        def concatenate(chunks, dtype):
+            return np.concatenate(chunks) if chunks else np.zeros(0, dtype=dtype)
+
+        term_ids = concatenate(term_chunks, np.int32)
+        order = np.argsort(term_ids, kind='stable')  # postings grouped by term, in document order
+        posting_docs = concatenate(doc_chunks, np.int32)[order]
+        posting_tfs = concatenate(tf_chunks, np.float32)[order]
+        del term_chunks, doc_chunks, tf_chunks, order
+        doc_lengths = concatenate(length_chunks, np.float32)
+        document_frequency = np.bincount(term_ids, minlength=len(vocabulary)).astype(np.float64)
+        idf = np.log(1.0 + (documents - document_frequency + 0.5) / (document_frequency + 0.5)).astype(np.float32)
+        term_offsets = np.zeros(len(vocabulary) + 1, dtype=np.int64)
+        term_offsets[1:] = np.cumsum(document_frequency)
+
+        embeddings = np.lib.format.open_memmap(
+            os.path.join(staging, "embeddings.npy"), mode="w+", dtype=np.float32, shape=(documents, dim)
+        ) if documents else np.zeros((0, dim), dtype=np.float32)
+        vectors = term_vectors(list(vocabulary), dim)
+        for term in range(len(vocabulary)):
+            start, end = term_offsets[term], term_offsets[term + 1]
+            weights = (1.0 + np.log(posting_tfs[start:end])) * idf[term]
+            embeddings[posting_docs[start:end]] += weights[:, None] * vectors[term]
+        for start in range(0, documents, 10000):
+            block = embeddings[start:start + 10000]
+            block /= np.maximum(np.linalg.norm(block, axis=1, keepdims=True), 1e-12)
+        if documents:
+            embeddings.flush()
+        else:
+            np.save(os.path.join(staging, "embeddings.npy"), embeddings)
+        del embeddings
 
-    cmd2 = f"""
-        SELECT get_presigned_URL(@{STAGE}, RELATIVE_PATH, 360) AS URL_LINK, RELATIVE_PATH
-        FROM directory(@{STAGE})
-        WHERE RELATIVE_PATH LIKE '%CALL_RECORDINGS%'
-    """
+        arrays = {
+            'idf': idf, 'term_offsets': term_offsets, 'posting_docs': posting_docs,
+            'posting_tfs': posting_tfs, 'doc_lengths': doc_lengths,
+        }
+        arrays.update((f"{column}.offsets", np.concatenate(offsets)) for column, offsets in text_offsets.items())
+        arrays.update((column, concatenate(chunks, np.float64)) for column, chunks in number_chunks.items())
+        for name, array in arrays.items():
+            np.save(os.path.join(staging, f"{name}.npy"), array)
+        with open(os.path.join(staging, "vocabulary.json"), "w") as f:
+            json.dump(list(vocabulary), f)
+        with open(os.path.join(staging, "meta.json"), "w") as f:
+            json.dump({
+                'version': version, 'documents': documents, 'dim': dim, 'columns': columns,
+                'average_length': float(doc_lengths.mean()) if documents else 0.0, 'built_at': time.time(),
+            }, f)
+
+        previous = f"{staging}.previous"
+        if os.path.exists(directory):
+            os.replace(directory, previous)
+        os.replace(staging, directory)
+        shutil.rmtree(previous, ignore_errors=True)
+
+    def value(self, column, doc):
+        data = self.columns[column]
+        if isinstance(data, tuple):
+            blob, offsets = data
+            return bytes(blob[offsets[doc]:offsets[doc + 1]]).decode()
+        return float(data[doc])
+
+    def search(self, question, limit, columns=('CHUNK', 'RELATIVE_PATH')):
+        """
+        Top limit documents for question as a DataFrame of columns plus SCORE, in rank order
+        """
+        documents = len(self.doc_lengths)
+        counts = {}
+        for token in search_tokens(question):
+            counts[token] = counts.get(token, 0) + 1
+        if not documents or not counts:
+            return pd.DataFrame(columns=[*columns, 'SCORE'])
+
+        known = [self.vocabulary[term] for term in counts if term in self.vocabulary]
+        unknown_idf = float(np.log(1.0 + (documents + 0.5) / 0.5))  # a term in no document
+        query_idf = sum(float(self.idf[term]) for term in known) + unknown_idf * (len(counts) - len(known))
+
+        bm25 = np.zeros(documents, dtype=np.float32)
+        coverage = np.zeros(documents, dtype=np.float32)
+        length_norm = self.k1 * (1.0 - self.b + self.b * np.asarray(self.doc_lengths) / max(self.meta['average_length'], 1e-6))
+        for term in known:
+            start, end = self.term_offsets[term], self.term_offsets[term + 1]
+            docs, tfs = self.posting_docs[start:end], self.posting_tfs[start:end]
+            bm25[docs] += self.idf[term] * tfs * (self.k1 + 1.0) / (tfs + length_norm[docs])
+            coverage[docs] += self.idf[term]
+        coverage /= query_idf
+
+        vectors = term_vectors(list(counts), self.meta['dim'])
+        weights = np.array([
+            (1.0 + np.log(count)) * (float(self.idf[self.vocabulary[term]]) if term in self.vocabulary else unknown_idf)
+            for term, count in counts.items()
+        ], dtype=np.float32)
+        query = weights @ vectors
+        query /= max(float(np.linalg.norm(query)), 1e-12)
+        cosine = np.clip(self.embeddings @ query, 0.0, 1.0)
+
+        alpha = local_search_alpha
+        fused = alpha * bm25 / max(float(bm25.max()), 1e-12) + (1.0 - alpha) * cosine
+        k = min(limit, documents)
+        top = np.argpartition(-fused, k - 1)[:k]
+        top = top[np.lexsort((top, -fused[top]))]
+        hits = pd.DataFrame({column: [self.value(column, doc) for doc in top] for column in columns})
+        hits['SCORE'] = (alpha * coverage[top] + (1.0 - alpha) * cosine[top]).astype(float)
+        return hits
+
+class LocalSearch:
+    """
+    First retrieval tier in front of a Cortex Search service: a HybridIndex built in this app
+    process from the table the service indexes (local_search_sources) and kept in local_search_dir.
+    The index is rebuilt in a background thread when the table's LAST_ALTERED differs from the
+    version it was built from (checked at most every table_version_ttl seconds); the previous
+    index keeps answering meanwhile. Until a first index exists, or when the table does not
+    exist, search() returns None.
+    """
+    def __init__(self, service_name):
+        self.service_name = service_name
+        self.directory = os.path.join(local_search_dir, service_name)
+        self._index = None
+        self._building = False
+        self._source = (None, None)  # (LAST_ALTERED in epoch milliseconds, ROW_COUNT) of the source table
+        self._probed_at = None
+        self._lock = threading.Lock()
+
+    def source(self):
+        database, schema = get_database_and_schema()
+        table, columns = local_search_sources[self.service_name]
+        return f"{database}.{schema}.{table}", columns
+
+    def source_version(self, table):
+        """
+        (LAST_ALTERED in epoch milliseconds, ROW_COUNT) of the source table, or (None, None) when it
+        does not exist, looked up in INFORMATION_SCHEMA at most every table_version_ttl seconds
+        """
+        now = time.monotonic()
+        with self._lock:
+            if self._probed_at is not None and now - self._probed_at <= table_version_ttl:
+                return self._source
+        database, schema, name = table.split(".")
+        cmd = f"""
+            SELECT DATE_PART(EPOCH_MILLISECOND, LAST_ALTERED) AS ALTERED_MS, ROW_COUNT
+            FROM {database}.INFORMATION_SCHEMA.TABLES
+            WHERE TABLE_SCHEMA = ? AND TABLE_NAME = ?
+        """
+        rows = session.sql(cmd, params=[schema, name]).collect()
+        source = (int(rows[0].ALTERED_MS), rows[0].ROW_COUNT) if rows else (None, None)
+        with self._lock:
+            self._source, self._probed_at = source, now
+        return source
+
+    def _build(self, table, columns, version):
+        try:
+            select = ", ".join(f"{source} AS {column}" for column, source in columns.items())
+            batches = session.sql(f"SELECT {select} FROM {table}").to_pandas_batches()
+            os.makedirs(local_search_dir, exist_ok=True)
+            HybridIndex.build(self.directory, batches, version, local_search_dim)
+            index = HybridIndex(self.directory)
+            with self._lock:
+                self._index = index
+        finally:
+            with self._lock:
+                self._building = False
+
+    def refresh(self, wait=False):
+        """
+        Open the persisted index, and start a rebuild if it is missing or older than the source table.
+        With wait, build in the calling thread instead.
+        """
+        table, columns = self.source()
+        version, row_count = self.source_version(table)
+        if version is None or (row_count or 0) > local_search_max_documents:
+            return None  # no source table, or too large to index in the app process: Cortex Search only
+        with self._lock:
+            if self._index is None and os.path.exists(os.path.join(self.directory, "meta.json")):
+                try:
+                    self._index = HybridIndex(self.directory)
+                except (OSError, ValueError, KeyError):
+                    self._index = None  # unreadable (e.g. an older layout): rebuilt below
+            if (self._index is not None and self._index.version == version) or self._building:
+                return self._index
+            self._building = True
+        if wait:
+            self._build(table, columns, version)
+        else:
+            threading.Thread(target=self._build, args=(table, columns, version), daemon=True,
+                             name=f"local-search-{self.service_name}").start()
+        return self._index
 
-    df_docs = session.sql(cmd2).to_pandas()
-    df_docs['RELATIVE_PATH'] = df_docs['RELATIVE_PATH'].str.replace(r'CALL_RECORDINGS/', 'call_recordings/', regex=True)
-    #df_docs['RELATIVE_PATH'] = df_docs['RELATIVE_PATH'].str.replace(r'CALL_RECORDINGS/', 'call_recordings/', regex=True)
-    df_referred = pd.merge(df_chunks, df_docs, on='RELATIVE_PATH', how='inner')[['RELATIVE_PATH', 'URL_LINK']].drop_duplicates()
+    def search(self, question, limit, columns):
+        """
+        Hits of the local index, or None when it has none yet or is not confident in its best hit
+        (its SCORE is below local_search_min_score), so the caller should ask Cortex Search
+        """
+        index = self.refresh()
+        if index is None or not set(columns) <= set(index.columns):
+            return None
+        hits = index.search(question, limit, columns)
+        if hits.empty or hits['SCORE'].iloc[0] < local_search_min_score:
+            return None
+        return hits
 
-    return similar_chunks, df_referred
+@st.cache_resource(show_spinner=False)
+def get_local_search(service_name):
+    """
+    One LocalSearch per Cortex Search service, shared by all sessions of this app process
+    """
+    return LocalSearch(service_name)
+
+def search_cortex(service_name, question, limit, return_scores=False, columns=('CHUNK', 'RELATIVE_PATH')):
+    """
+    Run a Cortex Search query and return the hits, in rank order, as a DataFrame
+    of the requested columns with a SCORE column (None when the service returns no score).
+    With local_search, the local hybrid index of the service answers first when it is confident;
+    it is not memoised, so it follows its table within table_version_ttl.
+    """
+    if local_search and service_name in local_search_sources:
+        with trace_span('local_search', service=service_name):
+            df_chunks = get_local_search(service_name).search(question, limit, columns)
+        if df_chunks is not None:
+            df_chunks['SCORE_TYPE'] = 'local'
+            return df_chunks
+    return query_search_service(service_name, question, limit, return_scores, columns)
 
 @st.cache_data(show_spinner=False)
-def get_similar_chunks_cortex_search(question):
+def query_search_service(service_name, question, limit, return_scores, columns):
     """
-    Get similar FAQ PDF docs using Cortex Search and return them 
-    along with a presigned URL to access the files
+    Hits of a Cortex Search service for question, see search_cortex()
     """
-    response = (
-        root.databases[DATABASE]
-        .schemas[SCHEMA]
-        .cortex_search_services["CALL_CENTER_FAQ_SEARCH"]
-        .search(
-            question,
-            ['CHUNK', 'RELATIVE_PATH'],
-            limit=num_chunks
+    options = {"experimental": {"returnConfidenceScores": True}} if return_scores else {}
+    response = get_search_service(service_name).search(
+        question,
+        list(columns),
+        limit=limit,
+        **options
+    )
+    df_chunks = pd.DataFrame(response.results, columns=list(columns))
+    scores = [get_hit_score(result) for result in response.results]
+    df_chunks['SCORE'] = [score for score, _ in scores]
+    df_chunks['SCORE_TYPE'] = [score_type for _, score_type in scores]
+    return df_chunks
+
+def get_hit_score(result):
+    """
+    Extract the relevance score of a Cortex Search hit and its type, preferring the confidence
+    score over the reranker score over the cosine similarity ((None, None) without a score)
+    """
+    if result.get('@CONFIDENCE_SCORE') is not None:
+        return float(result['@CONFIDENCE_SCORE']), 'confidence_score'
+    scores = result.get('@scores') or {}
+    for name in ('confidence_score', 'reranker_score', 'cosine_similarity'):
+        if scores.get(name) is not None:
+            return float(scores[name]), name
+    return None, None
+
+def select_relevant_hits(df_chunks, max_files):
+    """
+    Drop hits scoring below the search_score_thresholds entry of their score type, collapse the chunks of the same file
+    into one hit (in rank order) and stop once max_files distinct files are collected.
+    Timestamped segment hits (START_SECONDS / END_SECONDS columns) are put back in time order,
+    each prefixed with its time range, and the file's merged ranges are kept in TIME_RANGES.
+    """
+    timestamped = 'START_SECONDS' in df_chunks.columns
+    selected = OrderedDict()  # normalised path -> hit
+    segments = {}  # normalised path -> [(start, end, chunk)]
+    for _, row in df_chunks.iterrows():
+        score = row['SCORE']
+        threshold = search_score_thresholds.get(row.get('SCORE_TYPE'))
+        if threshold is not None and score is not None and not pd.isna(score) and score < threshold:
+            continue
+        key = normalize_stage_path(row['RELATIVE_PATH'])
+        if key in selected:
+            selected[key]['CHUNK'] += f"\n...\n{row['CHUNK']}"
+        elif len(selected) < max_files:
+            selected[key] = {'CHUNK': row['CHUNK'], 'RELATIVE_PATH': row['RELATIVE_PATH'], 'SCORE': score}
+        else:
+            continue
+        if timestamped:
+            segments.setdefault(key, []).append((float(row['START_SECONDS']), float(row['END_SECONDS']), row['CHUNK']))
+    if not timestamped:
+        return pd.DataFrame(list(selected.values()), columns=['CHUNK', 'RELATIVE_PATH', 'SCORE'])
+
+    for key, hit in selected.items():
+        ordered = sorted(segments[key])
+        hit['CHUNK'] = "\n...\n".join(
+            f"[{format_timestamp(start)}-{format_timestamp(end)}] {chunk}" for start, end, chunk in ordered
         )
+        hit['TIME_RANGES'] = merge_time_ranges([(start, end) for start, end, _ in ordered])
+    return pd.DataFrame(list(selected.values()), columns=['CHUNK', 'RELATIVE_PATH', 'SCORE', 'TIME_RANGES'])
+
+def format_timestamp(seconds):
+    """
+    Format an offset in seconds as m:ss (h:mm:ss past an hour)
+    """
+    minutes, seconds = divmod(int(seconds), 60)
+    hours, minutes = divmod(minutes, 60)
+    return f"{hours}:{minutes:02d}:{seconds:02d}" if hours else f"{minutes}:{seconds:02d}"
+
+def merge_time_ranges(ranges, gap=1.0):
+    """
+    Merge sorted (start, end) ranges that overlap or are less than gap seconds apart
+    """
+    merged = []
+    for start, end in ranges:
+        if merged and start - merged[-1][1] < gap:
+            merged[-1] = (merged[-1][0], max(merged[-1][1], end))
+        else:
+            merged.append((start, end))
+    return merged
+
+STOPWORDS = {
+    'a', 'an', 'and', 'are', 'as', 'at', 'be', 'by', 'can', 'did', 'do', 'does', 'for', 'from', 'give',
+    'has', 'have', 'how', 'i', 'if', 'in', 'is', 'it', 'me', 'my', 'of', 'on', 'or', 'share', 'so',
+    'that', 'the', 'this', 'to', 'was', 'what', 'when', 'where', 'which', 'who', 'with', 'you', 'your',
+}
+
+def estimate_tokens(text):
+    """
+    Rough token count (about 4 characters per token for English text)
+    """
+    return len(str(text)) // 4 + 1
+
+def query_terms(text):
+    """
+    Lower-cased content words of a text
+    """
+    return {term for term in re.findall(r"[a-z0-9]+", str(text).lower()) if term not in STOPWORDS}
+
+def split_passages(text):
+    """
+    Split a document into consecutive passages of about passage_tokens tokens, on sentence boundaries
+    """
+    passages, current = [], ""
+    for sentence in re.split(r"(?<=[.!?])\s+", str(text).strip()):
+        if current and estimate_tokens(current) + estimate_tokens(sentence) > passage_tokens:
+            passages.append(current)
+            current = sentence
+        else:
+            current = f"{current} {sentence}" if current else sentence
+    if current:
+        passages.append(current)
+    return passages
+
+def trim_document(text, question_terms, token_budget):
+    """
+    Keep the passages of a document that best match the question, in their original order,
+    within token_budget
+    """
+    if estimate_tokens(text) <= token_budget:
+        return text
+    passages = split_passages(text)
+    ranked = sorted(
+        range(len(passages)),
+        key=lambda i: (-len(question_terms & query_terms(passages[i])), i)
     )
+    keep, used = set(), 0
+    for i in ranked:
+        cost = estimate_tokens(passages[i])
+        if used + cost <= token_budget:
+            keep.add(i)
+            used += cost
+    if not keep:
+        return passages[ranked[0]][:token_budget * 4]
+    return " ... ".join(passages[i] for i in sorted(keep))
+
+def pack_context(df_chunks, chat_history, question, model):
+    """
+    Fit the ranked search hits and the chat history into the model's context token budget.
+    Chat history keeps its most recent messages within history_budget_share of the budget;
+    the remainder is shared by the documents (shortest first, so budget a short document
+    does not need rolls over to the longer ones), each trimmed to the passages that best
+    match the question. Documents stay in rank order.
+    Call summaries (SUMMARY column, see use_call_summaries()) are kept whole: their tokens are
+    reserved first and only the passages of their recording are trimmed.
+    Returns the packed hits, the packed chat history and the tokens used per section.
+    """
+    budget = context_token_budgets.get(model, default_context_token_budget)
+
+    history_budget = int(budget * history_budget_share)
+    packed_history, history_tokens = [], 0
+    for message in reversed(chat_history):
+        cost = estimate_tokens(message)
+        if history_tokens + cost > history_budget:
+            break
+        packed_history.insert(0, message)
+        history_tokens += cost
+
+    question_terms = query_terms(question)
+    summaries = df_chunks['SUMMARY'] if 'SUMMARY' in df_chunks.columns else pd.Series("", index=df_chunks.index)
+    summary_tokens = {i: estimate_tokens(summary) if summary else 0 for i, summary in summaries.items()}
+    remaining = budget - history_tokens - sum(summary_tokens.values())
+    packed_chunks = df_chunks.drop(columns=['SUMMARY'], errors='ignore')
+    document_tokens = {}
+    by_length = sorted(df_chunks.index, key=lambda i: len(str(df_chunks.at[i, 'CHUNK'])))
+    for position, i in enumerate(by_length):
+        share = max(0, remaining // (len(by_length) - position))
+        chunk = trim_document(df_chunks.at[i, 'CHUNK'], question_terms, share)
+        remaining -= estimate_tokens(chunk)
+        document_tokens[i] = estimate_tokens(chunk) + summary_tokens[i]
+        if summaries[i]:
+            chunk = f"{summaries[i]}\nRelevant passages:\n{chunk}"
+        packed_chunks.at[i, 'CHUNK'] = chunk
+
+    token_usage = {
+        'budget': budget,
+        'context': sum(document_tokens.values()),
+        'documents': [document_tokens[i] for i in df_chunks.index],
+        'chat_history': history_tokens,
+        'question': estimate_tokens(question),
+    }
+    return packed_chunks, packed_history, token_usage
 
-    results = response.results
-    df_chunks = pd.DataFrame(results, columns=['CHUNK', 'RELATIVE_PATH'])
-    similar_chunks = ''.join(
+def format_chunks(df_chunks):
+    """
+    Format search hits as the document block passed in the prompt context
+    """
+    return ''.join(
         f"""
         ### 
         Beginning of Document {i+1}
@@ -295,29 +1694,199 @@ def get_similar_chunks_cortex_search(question):
         for i, row in df_chunks.iterrows()
     ).replace("'", "")
 
-    cmd2 = f"""
-        SELECT get_presigned_URL(@{STAGE}, RELATIVE_PATH, 3600) AS URL_LINK, RELATIVE_PATH
-        FROM directory(@{STAGE})
-        WHERE RELATIVE_PATH LIKE '%FAQ%'
+@st.cache_data(show_spinner=False, ttl=call_summary_ttl)
+def query_call_summaries(audio_file_names):
+    """
+    Precomputed profiles (setup notebook) of the given recordings as a DataFrame indexed by AUDIO_FILE_NAME
+    """
+    database, schema = get_database_and_schema()
+    placeholders = ", ".join("?" for _ in audio_file_names)
+    cmd = f"""
+        SELECT AUDIO_FILE_NAME, SUMMARY, CALL_REASON, SENTIMENT, CLAIM_IDS, MEMBER_IDS, PROVIDERS
+        FROM {database}.{schema}.{call_summary_table}
+        WHERE AUDIO_FILE_NAME IN ({placeholders})
     """
+    return session.sql(cmd, params=list(audio_file_names)).to_pandas().set_index('AUDIO_FILE_NAME')
 
-    df_docs = session.sql(cmd2).to_pandas()
-    df_docs['RELATIVE_PATH'] = df_docs['RELATIVE_PATH'].str.replace(r'FAQ/', 'faq/', regex=True)
-    df_referred = pd.merge(df_chunks, df_docs, on='RELATIVE_PATH', how='inner')[['RELATIVE_PATH', 'URL_LINK']].drop_duplicates()
+def format_call_summary(summary):
+    """
+    Format the precomputed profile of a recording as the compact context passed in the prompt
+    """
+    entities = []
+    for label, column in (("Claim IDs", 'CLAIM_IDS'), ("Member IDs", 'MEMBER_IDS'), ("Providers", 'PROVIDERS')):
+        values = summary[column]
+        if isinstance(values, str):  # ARRAY columns come back as JSON text
+            values = json.loads(values)
+        if values:
+            entities.append(f"{label}: {', '.join(str(value) for value in values)}")
+    sentiment = summary['SENTIMENT']
+    lines = [
+        f"Call summary: {summary['SUMMARY']}",
+        f"Call reason: {summary['CALL_REASON']}",
+        f"Call sentiment: {'unknown' if pd.isna(sentiment) else f'{sentiment:+.2f} (-1 negative to +1 positive)'}",
+    ]
+    return "\n".join(lines + entities)
+
+def use_call_summaries(df_chunks):
+    """
+    Add the precomputed summary of each hit's recording as a SUMMARY column, which pack_context()
+    puts in front of its retrieved (timestamped) passages.
+    Recordings not summarised yet, or a deployment without the summary table, keep the passages alone.
+    """
+    if df_chunks.empty or object_missing(call_summary_table):
+        return df_chunks
+    try:
+        summaries = query_call_summaries(tuple(sorted(set(df_chunks['RELATIVE_PATH']))))
+    except Exception as e:
+        if not is_missing_object_error(e):
+            raise
+        note_missing_object(call_summary_table)
+        return df_chunks
+    df_chunks = df_chunks.copy()
+    df_chunks['SUMMARY'] = [
+        format_call_summary(summaries.loc[path]) if path in summaries.index and summaries.at[path, 'SUMMARY'] else ""
+        for path in df_chunks['RELATIVE_PATH']
+    ]
+    return df_chunks
+
+@traced('cortex_search_recordings')
+def get_similar_transcripts_cortex_search(question):
+    """
+    Get similar call transcripts using Cortex Search and return the hits
+    along with a presigned URL to access the files.
+    With segment_search the hits are timestamped segments, grouped per recording, and
+    the referred recordings carry the TIME_RANGES the answer is based on.
+    With call summaries on, each recording's passages are preceded by its precomputed summary.
+    """
+    df_chunks = None
+    if segment_search and not object_missing("CALL_CENTER_RECORDING_SEGMENT_SEARCH"):
+        try:
+            df_chunks = search_cortex(
+                "CALL_CENTER_RECORDING_SEGMENT_SEARCH", question, num_segments, search_return_scores,
+                ('CHUNK', 'RELATIVE_PATH', 'START_SECONDS', 'END_SECONDS')
+            )
+        except Exception as e:
+            # deployed before the setup notebook created the segment service: search whole transcripts
+            if not is_missing_object_error(e):
+                raise
+            note_missing_object("CALL_CENTER_RECORDING_SEGMENT_SEARCH")
+    if df_chunks is None:
+        df_chunks = search_cortex("CALL_CENTER_RECORDING_SEARCH_TX2", question, num_transcripts, search_return_scores)
+    df_chunks = select_relevant_hits(df_chunks, max_referenced_recordings)
+    if call_summary_table and st.session_state.call_summary_context:
+        df_chunks = use_call_summaries(df_chunks)
+    df_referred = get_stage_index('CALL_RECORDINGS', 360).referred_documents(df_chunks['RELATIVE_PATH'], presign=False)
+    if 'TIME_RANGES' in df_chunks.columns:
+        time_ranges = {
+            normalize_stage_path(path): ranges for path, ranges in zip(df_chunks['RELATIVE_PATH'], df_chunks['TIME_RANGES'])
+        }
+        df_referred['TIME_RANGES'] = [time_ranges.get(normalize_stage_path(path), []) for path in df_referred['RELATIVE_PATH']]
+
+    return df_chunks, df_referred
+
+@traced('cortex_search_faq')
+def get_similar_chunks_cortex_search(question):
+    """
+    Get similar FAQ PDF docs using Cortex Search and return the hits
+    along with a presigned URL to access the files
+    """
+    df_chunks = search_cortex("CALL_CENTER_FAQ_SEARCH", question, num_chunks, search_return_scores)
+    df_chunks = select_relevant_hits(df_chunks, num_chunks)
+    df_referred = get_stage_index('FAQ', 3600).referred_documents(df_chunks['RELATIVE_PATH'])
     
-    return similar_chunks, df_referred
+    return df_chunks, df_referred
+
+@traced('fold_memory')
+def fold_conversation(summary, messages, model, mode):
+    """
+    Fold messages into the running summary of the conversation with Cortex Complete
+    """
+    transcript = "\n".join(f"{message['role']}: {message['content']}" for message in messages)
+    prompt = f"""
+        You maintain the memory of a conversation between a contact center agent and an AI assistant.
+        Update the summary found between <summary> and </summary> tags with the new messages found between
+        <messages> and </messages> tags. Keep the member, calls, dates, amounts, decisions and open questions
+        mentioned; drop greetings and repetition. Use at most {memory_summary_words} words.
+        Answer with only the updated summary. Do not add any explanation.
+
+        <summary>
+        {summary}
+        </summary>
+        <messages>
+        {transcript}
+        </messages>
+    """
+    return get_cortex_client().complete(prompt, model, mode).strip()
+
+class ConversationMemory:
+    """
+    Rolling memory of one conversation. After each turn the messages older than the last
+    memory_verbatim_messages are folded into a running summary in the background; the chat
+    history of the next turn is that summary plus the messages not folded yet, so its size
+    stays roughly constant however long the conversation runs.
+    A fold still running when the next turn starts is not waited for: that turn uses the
+    previous summary and the (few) messages since.
+    """
+    def __init__(self):
+        self.summary = ""
+        self.folded = 0  # messages covered by the summary
+        self._pending = None  # (future, messages covered once it completes, trace of the fold)
+
+    def _collect(self):
+        if self._pending is None or not self._pending[0].done():
+            return
+        future, folded, trace = self._pending
+        self._pending = None
+        log_spans(trace, list(trace.spans))
+        try:
+            self.summary, self.folded = future.result(), folded
+        except Exception as e:
+            # the messages stay verbatim and are folded again after the next turn
+            if st.session_state.debug:
+                st.sidebar.warning(f"Could not update the conversation memory: {e}")
+
+    def history(self, messages):
+        """
+        Chat history to pass in the prompts: the running summary followed by the messages not folded into it
+        """
+        self._collect()
+        history = messages[self.folded:]
+        if self.summary:
+            history = [{"role": "summary", "content": self.summary}] + history
+        return history
+
+    def fold(self, messages, turn_id=None):
+        """
+        Start folding the messages older than the last exchange into the summary, unless a fold is running.
+        Its spans are recorded under turn_id (the turn that started it), even if it finishes during a later turn.
+        """
+        self._collect()
+        end = len(messages) - memory_verbatim_messages
+        if self._pending is not None or end <= self.folded:
+            return
+        trace = TurnTrace(turn_id)
+        executor = create_turn_executor(max_workers=1)
+        future = executor.submit(
+            run_in_trace, trace, fold_conversation, self.summary, messages[self.folded:end],
+            st.session_state.model_name, st.session_state.cortex_complete_type
+        )
+        executor.shutdown(wait=False)
+        self._pending = (future, end, trace)
 
 def get_chat_history():
     """
-    Get chat history based on a sliding window
+    Get chat history: the rolling conversation memory, or the last slide_window messages
     """
     if st.session_state.use_chat_history:
+        if rolling_memory:
+            return st.session_state.conversation_memory.history(st.session_state.messages)
         start_index = max(0, len(st.session_state.messages) - slide_window)
         chat_history = st.session_state.messages[start_index:]
         return chat_history
     return []
 
-def summarize_question_with_history(chat_history, question):
+@traced('summarize_question')
+def summarize_question_with_history(chat_history, question, restriction_prompt=None):
     """
     Create and execute prompt to summarize chat history
     """
@@ -335,7 +1904,7 @@ def summarize_question_with_history(chat_history, question):
         Question: {question}
     """
 
-    summary = execute_cortex_complete(prompt)
+    summary = execute_cortex_complete(prompt, cache_type='summary', restriction_prompt=restriction_prompt)
 
     if st.session_state.debug:
         st.text("Summary to be used to find similar chunks")
@@ -343,19 +1912,26 @@ def summarize_question_with_history(chat_history, question):
 
     return summary
 
-def create_prompt(myquestion, chat_history, intent):
+@traced('create_prompt')
+def create_prompt(myquestion, chat_history, intent, search_results=None):
     """
-    Create second level prompt where intent is Recordings or FAQ
+    Create second level prompt where intent is Recordings or FAQ.
+    search_results, when given, is the (hits, document URLs) pair already fetched by run_turn_fan_out()
     """
-    if st.session_state.cortex_search:
+    if search_results is not None:
+        df_chunks, df_document_urls = search_results
+    elif st.session_state.cortex_search:
         if intent == 'recordings':
-            prompt_context, df_document_urls = get_similar_transcripts_cortex_search(myquestion)
+            df_chunks, df_document_urls = get_similar_transcripts_cortex_search(myquestion)
         else:
-            prompt_context, df_document_urls = get_similar_chunks_cortex_search(myquestion)
+            df_chunks, df_document_urls = get_similar_chunks_cortex_search(myquestion)
     else:
-        prompt_context = ""
+        df_chunks = pd.DataFrame(columns=['CHUNK', 'RELATIVE_PATH'])
         df_document_urls = pd.DataFrame()
 
+    df_chunks, chat_history, token_usage = pack_context(df_chunks, chat_history, myquestion, st.session_state.model_name)
+    prompt_context = format_chunks(df_chunks)
+
     prompt = f"""
     You are an expert chat assistant that extracts information from the CONTEXT provided between <context> and </context> tags.
     You offer a chat experience considering the information included in the CHAT HISTORY provided between <chat_history> and </chat_history> tags.
@@ -377,6 +1953,13 @@ def create_prompt(myquestion, chat_history, intent):
     Answer:
     """
 
+    if st.session_state.debug:
+        st.caption(
+            f"Prompt tokens (estimated): context {token_usage['context']} {token_usage['documents']} | "
+            f"chat history {token_usage['chat_history']} | question {token_usage['question']} | "
+            f"budget {token_usage['budget']} | total prompt {estimate_tokens(prompt)}"
+        )
+
     if st.session_state.debug_prompt:
         st.text(f"Prompt being passed to {st.session_state.model_name}")
         st.caption(prompt)
@@ -439,9 +2022,60 @@ def create_prompt_find_intent(myquestion):
     """
     return prompt
 
-def create_prompt_summarize_cortex_analyst_results(myquestion, df, sql):
-    """
-    Create prompt to summarize Cortex Analyst results in natural language
+def fetch_analyst_result(sql_statement):
+    """
+    Run a Cortex Analyst SQL statement and fetch its result as a pandas DataFrame,
+    in Arrow batches, stopping after analyst_max_rows rows.
+    Returns the DataFrame and whether the result was truncated.
+    """
+    batches, rows = [], 0
+    for batch in session.sql(sql_statement).to_pandas_batches():
+        batches.append(batch)
+        rows += len(batch)
+        if rows > analyst_max_rows:
+            break
+    if not batches:
+        return pd.DataFrame(), False
+    df = pd.concat(batches, ignore_index=True)
+    return df.iloc[:analyst_max_rows], len(df) > analyst_max_rows
+
+def describe_result(df, truncated=False):
+    """
+    Compact text form of a result set for a prompt: schema, row count,
+    the first analyst_prompt_rows rows and summaries of the numeric columns
+    """
+    row_count = f"{len(df)}+ (truncated)" if truncated else str(len(df))
+    schema = ", ".join(f"{column} ({dtype})" for column, dtype in df.dtypes.astype(str).items())
+    text = f"Columns: {schema}\nRow count: {row_count}\n"
+    if df.empty:
+        return text
+    shown = "All rows" if len(df) <= analyst_prompt_rows else f"First {analyst_prompt_rows} rows"
+    text += f"{shown}:\n{df.head(analyst_prompt_rows).to_csv(index=False)}"
+    numeric = df.select_dtypes("number")
+    if len(df) > analyst_prompt_rows and not numeric.empty:
+        summary = numeric.agg(['count', 'sum', 'mean', 'min', 'max']).T
+        text += f"Numeric column summaries (over the {len(df)} fetched rows):\n{summary.to_csv()}"
+    return text
+
+def display_analyst_result(sql_statement, df, truncated, key):
+    """
+    Show the SQL of a Cortex Analyst answer and its result set, paginated
+    """
+    with st.expander("SQL Query"):
+        st.code(sql_statement)
+    with st.expander("Resultset"):
+        pages = max(1, -(-len(df) // analyst_page_size))
+        page = 1
+        if pages > 1:
+            page = st.number_input(f"Page (of {pages})", min_value=1, max_value=pages, value=1, key=f"result_page_{key}")
+        st.dataframe(df.iloc[(page - 1) * analyst_page_size:page * analyst_page_size])
+        if truncated:
+            st.caption(f"Only the first {analyst_max_rows} rows were fetched.")
+
+def create_prompt_summarize_cortex_analyst_results(myquestion, df, sql, truncated=False):
+    """
+    Create prompt to summarize Cortex Analyst results in natural language.
+    The result set is passed in the compact form of describe_result()
     """
     prompt = f"""
     You are an expert data analyst who translated the question contained between <question> and </question> tags:
@@ -459,7 +2093,7 @@ def create_prompt_summarize_cortex_analyst_results(myquestion, df, sql):
     And retrieved the following result set contained between <df> and </df> tags:
 
     <df>
-    {df}
+    {describe_result(df, truncated)}
     </df>
 
     Now share an answer to this question based on the SQL query and result set.
@@ -483,43 +2117,46 @@ def create_prompt_summarize_cortex_analyst_results(myquestion, df, sql):
 
     return prompt
 
-def complete(myquestion, chat_history, intent):
+def complete(myquestion, chat_history, intent, search_results=None, restriction_prompt=None):
     """
     Run create_prompt() and execute_cortex_complete() for cases where intent is Recordings or FAQ
     """
-    prompt, df_document_urls = create_prompt(myquestion, chat_history, intent)
-    response_txt = execute_cortex_complete(prompt)
+    prompt, df_document_urls = create_prompt(myquestion, chat_history, intent, search_results)
+    response_txt = execute_cortex_complete(prompt, restriction_prompt=restriction_prompt)
     return response_txt, df_document_urls
 
-def complete_for_cortex_analyst(prompt):
+def complete_for_cortex_analyst(prompt, restriction_prompt=None):
     """
     Run execute_cortex_complete() for Cortex Analyst
     """
-    response_txt = execute_cortex_complete(prompt)
+    response_txt = execute_cortex_complete(prompt, restriction_prompt=restriction_prompt)
     return response_txt
 
-def find_question_type(myquestion):
+@traced('find_intent')
+def find_question_type(myquestion, restriction_prompt=None):
     """
-    Run create_prompt() and execute_cortex_complete() to find intent
+    Run create_prompt() and execute_cortex_complete() to find intent.
+    Returns the response and the prompt, so the caller can show them in debug mode from the main thread
     """
     prompt = create_prompt_find_intent(myquestion)
-    response_txt = execute_cortex_complete(prompt)
-    if st.session_state.debug:
-        st.text(f"Prompt Passed to intent finding LLM {prompt}")
-        st.caption(f"""Intent found =  {response_txt}""")
-
-    return response_txt
+    response_txt = execute_cortex_complete(prompt, cache_type='intent', restriction_prompt=restriction_prompt)
+    return response_txt, prompt
 
-def find_violation(myquestion):
+@traced('violation_check')
+def find_violation(myquestion, member=None, restriction_prompt=None):
     """
     Run execute_cortex_complete() on a prompt to detect a violation whether 
-    a question contains any member names other than the one selected
+    a question contains any member names other than the one selected.
+    member is the (name, ID) the question is restricted to, by default the session's selected member when restricted
     """
-    if st.session_state.restricted_member:
+    if member is None and st.session_state.restricted_member:
+        member = (st.session_state.member_name, st.session_state.member_id)
+    if member:
+        member_name, member_id = member
         prompt = f"""
         You are an expert that determines whether a question violates the policy of accessing only data for the selected member.
 
-        If the question contains any member names other than {st.session_state.member_name} or member IDs other than {st.session_state.member_id} , then respond with 'Yes'.
+        If the question contains any member names other than {member_name} or member IDs other than {member_id} , then respond with 'Yes'.
         Otherwise, respond with 'No'.
 
         Be concise and ensure the response is strictly one word only and do not hallucinate.
@@ -529,16 +2166,79 @@ def find_violation(myquestion):
         </question>
         Answer:
         """
-        response_txt = execute_cortex_complete(prompt)
+        response_txt = execute_cortex_complete(prompt, cache_type='violation', restriction_prompt=restriction_prompt)
         response_txt = response_txt.strip().lower()
         return response_txt == 'yes'
     else:
         return False
 
+def create_turn_executor(max_workers=4):
+    """
+    Create a thread pool whose workers share the current Streamlit script run context,
+    so functions reading st.session_state can run off the main thread, and the trace
+    pinned to the current thread by run_in_trace(), if any
+    """
+    ctx = get_script_run_ctx()
+    trace = getattr(thread_trace, 'trace', None)
+
+    def initializer():
+        add_script_run_ctx(threading.current_thread(), ctx)
+        if trace is not None:
+            thread_trace.trace = trace
+    return ThreadPoolExecutor(max_workers=max_workers, initializer=initializer)
+
+def run_turn_fan_out(question_summary, search_question, member=None, restriction_prompt=None):
+    """
+    Run the independent steps of a chat turn concurrently instead of one after the other:
+        - the violation check and intent classification run together
+        - both Cortex Search services are queried speculatively while the intent is being decided
+    Branches that turn out to be unneeded are cancelled (or left to finish in the background
+    if already running, their result discarded).
+    Returns (is_violation, intent, search_results) where search_results is the
+    (hits, document URLs) pair of the search matching the intent, or None.
+    Workers never render: debug output is written here, on the script thread.
+    member and restriction_prompt default to the session's, see find_violation() and execute_cortex_complete().
+    """
+    if not intent_routing:
+        if not st.session_state.cortex_search:
+            return False, 'recordings', None
+        return False, 'recordings', get_similar_transcripts_cortex_search(search_question)
+
+    executor = create_turn_executor()
+    try:
+        violation = executor.submit(find_violation, question_summary, member, restriction_prompt)
+        question_type = executor.submit(find_question_type, question_summary, restriction_prompt)
+        searches = {}
+        if st.session_state.cortex_search:
+            searches['recordings'] = executor.submit(get_similar_transcripts_cortex_search, search_question)
+            searches['faq'] = executor.submit(get_similar_chunks_cortex_search, search_question)
+
+        if violation.result():
+            for future in [question_type, *searches.values()]:
+                future.cancel()
+            return True, None, None
+
+        response_txt, intent_prompt = question_type.result()
+        if st.session_state.debug:
+            st.text(f"Prompt Passed to intent finding LLM {intent_prompt}")
+            st.caption(f"""Intent found =  {response_txt}""")
+        intent = response_txt.strip().lower() if len(response_txt) > 0 else 'unknown'
+        needed = None if intent == 'data' else ('recordings' if intent == 'recordings' else 'faq')
+        for branch, future in searches.items():
+            if branch != needed:
+                future.cancel()
+        search_results = searches[needed].result() if needed in searches else None
+        return False, intent, search_results
+    finally:
+        executor.shutdown(wait=False, cancel_futures=True)
+
+@traced('cortex_analyst')
 def send_message(prompt: str) -> dict:
     """
     Make an API call to Cortex Analyst
     """
+    import _snowflake
+    database, schema = get_database_and_schema()
     request_body = {
         "messages": [
             {
@@ -551,7 +2251,7 @@ def send_message(prompt: str) -> dict:
                 ]
             }
         ],
-        "semantic_model_file": f"@{DATABASE}.{SCHEMA}.{STAGE}/{FILE}",
+        "semantic_model_file": f"@{database}.{schema}.{STAGE}/{FILE}",
     }
     resp = _snowflake.send_snow_api_request(
         "POST",
@@ -567,19 +2267,167 @@ def send_message(prompt: str) -> dict:
     else:
         raise Exception(f"Failed request with status {resp['status']}: {resp}")
 
-def process_message(prompt: str, question_summary: str, summary_msg: str):
+def normalize_question(question):
+    """
+    Case, whitespace and trailing punctuation insensitive form of a question, used as a cache key
+    """
+    return re.sub(r"\s+", " ", str(question)).strip().rstrip("?.! ").lower()
+
+def normalize_sql(sql_statement):
+    """
+    Whitespace insensitive form of a SQL statement, used as a cache key
+    """
+    return re.sub(r"\s+", " ", sql_statement).strip().rstrip(";")
+
+def referenced_tables(sql_statement):
     """
-    Process messages
+    Fully qualified (upper-cased) names of the tables a SQL statement reads from.
+    CTE names are returned too; they are not found in INFORMATION_SCHEMA and are ignored there.
     """
-    st.session_state.messages.append({"role": "user", "content": prompt})
+    database, schema = get_database_and_schema()
+    tables = set()
+    for name in re.findall(r'\b(?:FROM|JOIN)\s+((?:"[^"]+"|[\w$]+)(?:\s*\.\s*(?:"[^"]+"|[\w$]+)){0,2})', sql_statement, re.I):
+        parts = [part.strip().strip('"').upper() for part in name.split(".")]
+        parts = [database.upper(), schema.upper()][:3 - len(parts)] + parts
+        tables.add(".".join(parts))
+    return tuple(sorted(tables))
+
+class AnalystCache:
+    """
+    Process-wide caches for Cortex Analyst, shared by all sessions:
+        - Analyst responses (the generated SQL) by normalised question and semantic model file
+        - result sets by normalised SQL text
+    Every entry remembers the LAST_ALTERED of the tables its SQL reads and is dropped once any
+    of them changes. LAST_ALTERED is looked up at most every table_version_ttl seconds per table,
+    so a repeated question within that window needs neither an Analyst call nor a query.
+    (For a view, LAST_ALTERED only changes with its definition, not with its base tables.)
+    """
+    def __init__(self, max_responses, max_results):
+        self.max_responses = max_responses
+        self.max_results = max_results
+        self._responses = OrderedDict()  # (question, semantic model file) -> entry
+        self._results = OrderedDict()    # SQL -> entry
+        self._versions = {}  # table -> (LAST_ALTERED in epoch milliseconds or None, monotonic time checked)
+        self._lock = threading.Lock()  # guards the entry stores, never held across a query
+        self._versions_lock = threading.Lock()
+
+    def table_versions(self, tables):
+        """
+        {table: LAST_ALTERED} for tables, querying INFORMATION_SCHEMA for the ones not checked recently
+        """
+        now = time.monotonic()
+        with self._versions_lock:
+            stale = [table for table in tables
+                     if table not in self._versions or now - self._versions[table][1] > table_version_ttl]
+        by_schema = {}
+        for table in stale:
+            database, schema, name = table.split(".")
+            by_schema.setdefault((database, schema), []).append(name)
+        for (database, schema), names in by_schema.items():
+            cmd = f"""
+                SELECT TABLE_NAME, DATE_PART(EPOCH_MILLISECOND, LAST_ALTERED) AS ALTERED_MS
+                FROM {database}.INFORMATION_SCHEMA.TABLES
+                WHERE TABLE_SCHEMA = ? AND TABLE_NAME IN ({', '.join('?' for _ in names)})
+            """
+            altered = {row.TABLE_NAME: row.ALTERED_MS for row in session.sql(cmd, params=[schema, *names]).collect()}
+            with self._versions_lock:
+                for name in names:
+                    self._versions[f"{database}.{schema}.{name}"] = (altered.get(name), now)
+        with self._versions_lock:
+            return {table: self._versions[table][0] for table in tables}
+
+    def _get(self, store, key):
+        with self._lock:
+            entry = store.get(key)
+        if entry is None:
+            return None
+        # table versions are checked without holding the lock: they may need a warehouse query
+        fresh = (time.monotonic() - entry['stored_at'] <= analyst_cache_ttl
+                 and self.table_versions(entry['tables']) == entry['versions'])
+        with self._lock:
+            if store.get(key) is entry:
+                if fresh:
+                    store.move_to_end(key)
+                else:
+                    del store[key]
+        return entry['value'] if fresh else None
+
+    def _put(self, store, key, value, sql_statement, max_entries):
+        tables = referenced_tables(sql_statement) if sql_statement else ()
+        versions = self.table_versions(tables)
+        with self._lock:
+            store[key] = {
+                'value': value,
+                'tables': tables,
+                'versions': versions,
+                'stored_at': time.monotonic(),
+            }
+            store.move_to_end(key)
+            while len(store) > max_entries:
+                store.popitem(last=False)
+
+    def get_response(self, question, model_file):
+        return self._get(self._responses, (normalize_question(question), model_file))
+
+    def put_response(self, question, model_file, response, sql_statement):
+        self._put(self._responses, (normalize_question(question), model_file), response, sql_statement, self.max_responses)
+
+    def get_result(self, sql_statement):
+        return self._get(self._results, normalize_sql(sql_statement))
+
+    def put_result(self, sql_statement, result):
+        self._put(self._results, normalize_sql(sql_statement), result, sql_statement, self.max_results)
+
+@st.cache_resource(show_spinner=False)
+def get_analyst_cache():
+    """
+    One AnalystCache shared by all sessions of this app process
+    """
+    return AnalystCache(analyst_cache_max_responses, analyst_cache_max_results)
+
+def get_analyst_response(prompt):
+    """
+    Cortex Analyst response for prompt, from the Analyst cache when the same question was
+    answered before and the tables its SQL reads have not changed since
+    """
+    database, schema = get_database_and_schema()
+    model_file = f"@{database}.{schema}.{STAGE}/{FILE}"
+    cache = get_analyst_cache()
+    response = cache.get_response(prompt, model_file)
+    if response is not None:
+        if st.session_state.debug:
+            st.caption("Cortex Analyst response served from cache")
+        return response
+    response = send_message(prompt)
+    statements = [item["statement"] for item in response["message"]["content"] if item["type"] == "sql"]
+    if statements:  # only answers with SQL can be invalidated by table changes
+        cache.put_response(prompt, model_file, response, statements[0])
+    return response
 
+def get_analyst_result(sql_statement):
+    """
+    fetch_analyst_result() through the Analyst result cache
+    """
+    cache = get_analyst_cache()
+    result = cache.get_result(sql_statement)
+    if result is None:
+        result = fetch_analyst_result(sql_statement)
+        cache.put_result(sql_statement, result)
+    elif st.session_state.debug:
+        st.caption("Result set served from cache")
+    return result
+
+def process_message(prompt: str, question_summary: str, summary_msg: str):
+    """
+    Process messages (the user message is already in the history, appended by main())
+    """
     with st.chat_message("assistant"):
         if len(st.session_state.messages) > 1:
             st.markdown(summary_msg)
         msg = f"""Based on the insights from Cortex AI, this seems to be a question appropriate for the Contact Center Member 360 Data Product. \n Initiating Contact Center Analyst agent to help answer this question."""
         st.write(msg)
         with st.spinner("Contact Center Analyst Agent thinking..."):
-            response = send_message(prompt= f"{question_summary} . {st.session_state.restriction_prompt}")
+            response = get_analyst_response(prompt= f"{question_summary} . {st.session_state.restriction_prompt}")
             content = response["message"]["content"]
             response_string = display_content_new(content=content, prompt=question_summary)
     st.session_state.messages.append({"role": "assistant", "content": response_string})
@@ -597,7 +2445,7 @@ def display_content_new(content: list, prompt, message_index: int = None):
     message_index = message_index or len(st.session_state.messages)
     final_response = "Please refine that question"
     sql_statement = "Not Applicable"
-    df = ""
+    df, truncated = pd.DataFrame(), False
     for item in content:
         if item["type"] == "text":
             final_response = item["text"]
@@ -611,9 +2459,10 @@ def display_content_new(content: list, prompt, message_index: int = None):
                         st.session_state.active_suggestion = suggestion
         elif item["type"] == "sql":
             sql_statement = item["statement"]
-            df = session.sql(sql_statement).collect()
+            with trace_span('analyst_sql'):
+                df, truncated = get_analyst_result(sql_statement)
             question_summary = prompt
-            prompt_refined = create_prompt_summarize_cortex_analyst_results(question_summary, df, sql_statement)
+            prompt_refined = create_prompt_summarize_cortex_analyst_results(question_summary, df, sql_statement, truncated)
             final_response = complete_for_cortex_analyst(prompt_refined)
         
         # Display the answer with some minimal refinement
@@ -626,20 +2475,103 @@ def display_content_new(content: list, prompt, message_index: int = None):
             #st.markdown(final_response) - suppressing to remove the double messaging
             st.markdown("")
 
-        # Display SQL and Resultset if applicable
-        if sql_statement != "Not Applicable":
-            with st.expander("SQL Query"):
-                st.code(sql_statement)
-            with st.expander("Resultset"):
-             st.write(df)
+    # Display SQL and Resultset if applicable, kept with the answer so pages can be browsed on reruns
+    if sql_statement != "Not Applicable":
+        st.session_state.message_results[message_index] = (sql_statement, df, truncated)
+        display_analyst_result(sql_statement, df, truncated, message_index)
 
     return final_response
 
-@st.cache_data(show_spinner=False)
+class MemberIndex:
+    """
+    Process-wide phone number -> member context index over the one-row-per-phone
+    lookup table built by the setup notebook (CALL_CENTER_MEMBER_LOOKUP).
+
+    The table is loaded in bulk, then only rows with a newer UPDATED_AT are re-read, at most
+    every member_index_refresh seconds (or member_index_min_refresh seconds on a lookup miss).
+    It is fully reloaded once member_index_ttl has elapsed, which drops deleted phone numbers.
+    """
+    def __init__(self, table):
+        self.table = table
+        self._members = {}  # phone number -> (member id, name, caller intent, additional info)
+        self._loaded_at = None
+        self._checked_at = None
+        self._watermark = 0  # newest UPDATED_AT seen, in epoch milliseconds
+        self._lock = threading.Lock()
+
+    def _load(self, members, since=0):
+        """
+        Add the rows updated after 'since' (epoch milliseconds) to members and return the newest UPDATED_AT seen
+        """
+        database, schema = get_database_and_schema()
+        cmd = f"""
+            SELECT MEMBER_PHONE, MEMBER_ID, NAME, POTENTIAL_CALLER_INTENT, ADDITIONAL_INFO,
+                DATE_PART(EPOCH_MILLISECOND, UPDATED_AT) AS UPDATED_MS
+            FROM {database}.{schema}.{self.table}
+            WHERE DATE_PART(EPOCH_MILLISECOND, UPDATED_AT) > ?
+        """
+        watermark = since
+        for row in session.sql(cmd, params=[since]).to_pandas().itertuples(index=False):
+            members[row.MEMBER_PHONE] = (row.MEMBER_ID, row.NAME, row.POTENTIAL_CALLER_INTENT, row.ADDITIONAL_INFO)
+            watermark = max(watermark, row.UPDATED_MS)
+        return watermark
+
+    def refresh(self, full=False):
+        with self._lock:
+            now = time.monotonic()
+            if full or self._loaded_at is None or now - self._loaded_at > member_index_ttl:
+                members = {}
+                self._watermark = self._load(members)
+                self._members = members
+                self._loaded_at = self._checked_at = now
+            else:
+                self._watermark = self._load(self._members, since=self._watermark)
+                self._checked_at = now
+
+    def get(self, phone_number):
+        """
+        Member context of a phone number as (member id, name, caller intent, additional info), or None
+        """
+        now = time.monotonic()
+        if (self._loaded_at is None
+                or now - self._loaded_at > member_index_ttl
+                or now - self._checked_at > member_index_refresh
+                or (phone_number not in self._members and now - self._checked_at > member_index_min_refresh)):
+            self.refresh()
+        return self._members.get(phone_number)
+
+@st.cache_resource(show_spinner=False)
+def get_member_index():
+    """
+    One MemberIndex shared by all sessions of this app process
+    """
+    return MemberIndex(member_lookup_table)
+
 def get_member_details(phone_number):
+    """
+    Get the member details of a phone number: an in-memory lookup in the member index,
+    or a query on the denormalised view when member_lookup_table is not set or does not exist yet
+    """
+    if not member_lookup_table or object_missing(member_lookup_table):
+        return query_member_details(phone_number)
+    try:
+        member = get_member_index().get(phone_number)
+    except Exception as e:
+        # deployed before the setup notebook created the lookup table
+        if not is_missing_object_error(e):
+            raise
+        note_missing_object(member_lookup_table)
+        return query_member_details(phone_number)
+    if member is None:
+        return None, None, None, None  # Ensure four values are returned
+    return member
+
+@st.cache_data(show_spinner=False)
+def query_member_details(phone_number):
     """
     Run a query to get member details and extract values
     """
+    database, schema = get_database_and_schema()
     query = f"""
         SELECT MEMBER_ID, NAME, 
         CASE WHEN POTENTIAL_CALLER_INTENT = 'Active Grievance' THEN POTENTIAL_CALLER_INTENT||':'||GRIEVANCE_TYPE
@@ -650,7 +2582,7 @@ def get_member_details(phone_number):
                         WHEN POTENTIAL_CALLER_INTENT = 'Active Grievance' AND Grievance_Type = 'Delay in claim processing' Then ' Retrieve related Claim details as well'
                         ELSE '' 
                     END ADDITIONAL_INFO
-        FROM {DATABASE}.{SCHEMA}.CALL_CENTER_MEMBER_DENORMALIZED_WITH_INTENT
+        FROM {database}.{schema}.CALL_CENTER_MEMBER_DENORMALIZED_WITH_INTENT
         WHERE member_phone = ?
     """
 
@@ -672,6 +2604,9 @@ def on_phone_number_change():
     st.session_state['restricted_member_toggle'] = False
     
     st.session_state.messages = [] #resetting messages
+    st.session_state.message_references = {}
+    st.session_state.message_results = {}
+    st.session_state.conversation_memory = ConversationMemory()
     phone_number = st.session_state.phone_number
     try:
         member_id, member_name, caller_intent, additional_info = get_member_details(phone_number)
@@ -940,6 +2875,7 @@ def send_email(recipient_email, subject, body):
 def main():
     st.title(f"Audio Transcription Agent")
     st.subheader(f":snowflake::snowflake: Powered by Snowflake Cortex :snowflake::snowflake:")
+    first_paint = time.perf_counter() - script_start
 
     clear_conversation = config_options()
     init_messages(clear_conversation)
@@ -953,9 +2889,13 @@ def main():
     else:
         st.session_state.restriction_prompt = ""
 
-    for message in st.session_state.messages:
+    for message_index, message in enumerate(st.session_state.messages):
         with st.chat_message(message["role"]):
             st.markdown(message["content"])
+            if message_index in st.session_state.message_references:
+                display_recording_references(st.session_state.message_references[message_index], message_index)
+            if message_index in st.session_state.message_results:
+                display_analyst_result(*st.session_state.message_results[message_index], message_index)
 
     # Always display the input box
     user_input = st.chat_input("Ask a question")
@@ -977,6 +2917,7 @@ def main():
         question = None
 
     if question:
+        trace = start_turn()
         st.session_state['show_next_best_action'] = False
         chat_history = get_chat_history()
         with st.chat_message("user"):
@@ -989,66 +2930,73 @@ def main():
             question_summary = question_summary.replace("or supporting documentation", "")
 
         summary_msg = f"""By evaluating the question and the chat history. Cortex AI is interpreting the question as below \n \n  *'{question_summary}'* \n \n Please 'start over' or refine the question if this intepretation is inaccurate. \n"""
-        intent = 'recordings'
-        # # First, check for a violation
-        # is_violation = find_violation(question_summary)
-        # if is_violation:
-        #     with st.chat_message("assistant"):
-        #         response_text = f"""Identified a security violation. Please ensure your question is related to the selected member {st.session_state.member_id} | {st.session_state.member_name}.
-        #         Please refine the question."""
-        #         st.write(response_text)
-        #     st.session_state.messages.append({"role": "assistant", "content": response_text})
-        # else:
-        #     # Then determine the question type
-        #     response_txt = find_question_type(question_summary)
-        #     if len(response_txt) > 0:
-        #         intent = response_txt.strip().lower()
-        #     else:
-        #         intent = 'unknown'
-
-        #     if intent == 'data':
-        #         process_message(prompt=question, question_summary=question_summary, summary_msg=summary_msg)
-        #     else:
-        with st.chat_message("assistant"):
-            if intent == 'recordings':
-                msg = "Based on the insights from Cortex AI, this seems to be a question related to call recordings.\nInitiating Call Recordings Search Agent."
-                Agent = "Call Recordings Search Agent"
-            else:
-                msg = "Based on the insights from Cortex AI, this seems to be a Contact Center Knowledge Store based question.\nInitiating Knowledge Store Search Agent."
-                Agent = "Knowledge Store Search Agent"
-            if len(st.session_state.messages) > 1:
-                st.markdown(summary_msg)
-            st.write(msg)
-            message_placeholder = st.empty()
-            question = question_summary.replace("", "")
-            question = f"{question} .{st.session_state.restriction_prompt}"
-
-            with st.spinner(f"{Agent} thinking..."):
-                response, df_document_urls = complete(question, chat_history, intent)
-                
-        
-                if len(response) > 0:
-                    response_text = response
+        search_question = f"{question_summary} .{st.session_state.restriction_prompt}"
+        # Violation check, intent classification and Cortex Search run concurrently
+        with st.spinner("Cortex AI thinking..."):
+            is_violation, intent, search_results = run_turn_fan_out(question_summary, search_question)
+
+        if is_violation:
+            with st.chat_message("assistant"):
+                response_text = f"""Identified a security violation. Please ensure your question is related to the selected member {st.session_state.member_id} | {st.session_state.member_name}.
+                Please refine the question."""
+                st.write(response_text)
+            st.session_state.messages.append({"role": "assistant", "content": response_text})
+        elif intent == 'data':
+            process_message(prompt=question, question_summary=question_summary, summary_msg=summary_msg)
+        else:
+            with st.chat_message("assistant"):
+                if intent == 'recordings':
+                    msg = "Based on the insights from Cortex AI, this seems to be a question related to call recordings.\nInitiating Call Recordings Search Agent."
+                    Agent = "Call Recordings Search Agent"
                 else:
-                    response_text = "No response received from Cortex AI."
-
-                message_placeholder.markdown(response_text)
-                if not df_document_urls.empty:
-                    if intent == 'recordings':
-                        st.markdown("The following call recordings were referred for this answer:")
-                        for _, row in df_document_urls.iterrows():
-                            relative_path = row['RELATIVE_PATH'].replace(r'call_recordings/', 'CALL_RECORDINGS/')
-                            url_link = row['URL_LINK']
-                            st.write(f"Call Recording : {relative_path}")
-                            st.audio(url_link, format="audio/mpeg", loop=True)
-                            #display_file_with_scrollbar(relative_path, unique_key=relative_path,file_type="audio")
+                    msg = "Based on the insights from Cortex AI, this seems to be a Contact Center Knowledge Store based question.\nInitiating Knowledge Store Search Agent."
+                    Agent = "Knowledge Store Search Agent"
+                if len(st.session_state.messages) > 1:
+                    st.markdown(summary_msg)
+                st.write(msg)
+                message_placeholder = st.empty()
+                question = search_question
+
+                with st.spinner(f"{Agent} thinking..."):
+                    if st.session_state.stream_response:
+                        prompt, df_document_urls = create_prompt(question, chat_history, intent, search_results)
+                        response, timings = render_stream(stream_cortex_complete(prompt), message_placeholder)
                     else:
-                        st.markdown("The following documents were referred for this answer:")
-                        for _, row in df_document_urls.iterrows():
-                            relative_path = row['RELATIVE_PATH']
-                            display_file_with_scrollbar(relative_path, unique_key=relative_path,file_type="pdf")
+                        start = time.perf_counter()
+                        response, df_document_urls = complete(question, chat_history, intent, search_results)
+                        generation_time = time.perf_counter() - start
+                        timings = {'time_to_first_token': generation_time, 'generation_time': generation_time}
+                    st.session_state.turn_timings.append(timings)
+                    del st.session_state.turn_timings[:-turn_timings_kept]
+                    if st.session_state.debug:
+                        st.sidebar.caption(
+                            f"Time to first token: {timings['time_to_first_token']:.2f}s | "
+                            f"Total generation time: {timings['generation_time']:.2f}s"
+                        )
 
-                st.session_state.messages.append({"role": "assistant", "content": response_text})
+                    if len(response) > 0:
+                        response_text = response
+                    else:
+                        response_text = "No response received from Cortex AI."
+
+                    message_placeholder.markdown(response_text)
+                    if not df_document_urls.empty:
+                        if intent == 'recordings':
+                            # kept with the answer so the reference panel is listed again on reruns
+                            message_index = len(st.session_state.messages)
+                            references = df_document_urls.drop(columns=['URL_LINK']).to_dict('records')
+                            st.session_state.message_references[message_index] = references
+                            display_recording_references(references, message_index)
+                        else:
+                            st.markdown("The following documents were referred for this answer:")
+                            for _, row in df_document_urls.iterrows():
+                                relative_path = row['RELATIVE_PATH']
+                                display_file_with_scrollbar(relative_path, unique_key=relative_path,file_type="pdf")
+
+                    st.session_state.messages.append({"role": "assistant", "content": response_text})
+        finish_turn(trace)
+        if rolling_memory:
+            st.session_state.conversation_memory.fold(st.session_state.messages, trace.turn_id)
 
     # Move Next Best Action as a checkbox under the chatbox
     if len(st.session_state.messages) > 0:
@@ -1104,12 +3052,25 @@ def main():
                                 st.session_state['edited_body'] = st.session_state.edited_body 
                             
     if 'active_suggestion' in st.session_state and st.session_state.active_suggestion:
+        suggestion = st.session_state.active_suggestion
+        trace = start_turn()
+        with st.chat_message("user"):
+            st.markdown(suggestion)
+        st.session_state.messages.append({"role": "user", "content": suggestion})
         process_message(
-                prompt=st.session_state.active_suggestion,
-                question_summary=st.session_state.active_suggestion,
+                prompt=suggestion,
+                question_summary=suggestion,
                 summary_msg=""
                         )
         st.session_state.active_suggestion = None
+        finish_turn(trace)
+        if rolling_memory:
+            st.session_state.conversation_memory.fold(st.session_state.messages, trace.turn_id)
+
+    if st.session_state.debug:
+        st.sidebar.caption(f"This run: imports {import_time:.3f}s | first paint {first_paint:.3f}s after script start")
+        display_llm_call_stats()
+        display_turn_spans()
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,10 @@
+"""
+Headless batch question answering with the chat turn pipeline of audio.py.
+
+Questions are read from a JSONL file, answered concurrently without the Streamlit UI and
+the answers, referenced documents and per-stage timings are written to a JSONL file:
+
+    cd streamlit
+    python -m batch questions.jsonl --output answers.jsonl --stubs
+    python -m batch questions.jsonl --output answers.jsonl --connection my_connection --concurrency 8 --rate 4
+"""
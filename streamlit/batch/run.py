@@ -0,0 +1,229 @@
+"""
+Answer a JSONL file of questions with the chat turn pipeline of audio.py and write one JSON
+answer per line. Each input line is an object with a "question" and optionally:
+    id            identifier copied to the answer (defaults to the line number)
+    phone_number  caller phone number, resolved to the member with the member index
+    member_name   member the question is about (overrides the phone number lookup)
+    member_id     ID of that member, checked by the violation check with member_name
+    intent        'recordings', 'faq' or 'data' to skip the intent routing
+    history       prior chat messages ({"role": ..., "content": ...}) the question follows
+"""
+import argparse
+import dataclasses
+import json
+import logging
+import os
+import statistics
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+def load_app(args):
+    """
+    Create the Snowpark session (or install the stand-ins), import audio.py and
+    prime the session state its chat turn functions read
+    """
+    if args.stubs:
+        from bench import stubs
+        stubs.install(stubs.StubConfig(**{
+            field.name: getattr(args, field.name) for field in dataclasses.fields(stubs.StubConfig)
+        }))
+    else:
+        from snowflake.snowpark import Session
+        builder = Session.builder
+        if args.connection:
+            builder = builder.config("connection_name", args.connection)
+        builder.create()  # becomes the session returned by get_active_session() in audio.py
+    logging.disable(logging.WARNING)  # silence the bare-mode (no `streamlit run`) warnings
+    sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    import audio
+    import streamlit as st
+    # Shared by all workers: only settings live here, the member context of a question
+    # is passed explicitly to the violation check and the Cortex Complete calls
+    st.session_state.update(
+        messages=[], use_chat_history=True, summarize_with_chat_history=True, cortex_search=True,
+        debug=False, debug_prompt=False, model_name=args.model, cortex_complete_type=args.complete_type,
+        call_summary_context=audio.call_summary_context,
+        restriction_prompt='', restricted_member=False, member_name='', member_id='', turn_timings=[],
+        message_references={}, message_results={}, conversation_memory=audio.ConversationMemory(),
+    )
+    return audio
+
+def read_questions(path):
+    with open(path) as f:
+        for line_number, line in enumerate(f, 1):
+            if line.strip():
+                record = json.loads(line)
+                record.setdefault('id', line_number)
+                yield record
+
+class RateLimiter:
+    """
+    Space the starts of the questions at least 1 / rate seconds apart across all workers
+    """
+    def __init__(self, rate):
+        self.interval = 1.0 / rate if rate else 0.0
+        self._next = time.monotonic()
+        self._lock = threading.Lock()
+
+    def wait(self):
+        if not self.interval:
+            return
+        with self._lock:
+            now = time.monotonic()
+            start = max(now, self._next)
+            self._next = start + self.interval
+        time.sleep(start - now)
+
+def answer_analyst(audio, trace, question_summary, restriction_prompt):
+    """
+    Cortex Analyst path of a chat turn: the generated SQL, its result and the summarised answer
+    """
+    answer = {'answer': "Please refine that question", 'sql': None, 'suggestions': []}
+    with trace.span('analyst'):
+        response = audio.get_analyst_response(f"{question_summary} . {restriction_prompt}")
+    for item in response["message"]["content"]:
+        if item["type"] == "text":
+            answer['answer'] = item["text"]
+        elif item["type"] == "suggestions":
+            answer['answer'] = ""
+            answer['suggestions'] = item["suggestions"]
+        elif item["type"] == "sql":
+            answer['sql'] = item["statement"]
+            with trace.span('analyst_sql'):
+                df, truncated = audio.get_analyst_result(item["statement"])
+            with trace.span('answer'):
+                prompt = audio.create_prompt_summarize_cortex_analyst_results(question_summary, df, item["statement"], truncated)
+                answer['answer'] = audio.complete_for_cortex_analyst(prompt, restriction_prompt)
+            answer.update(rows=len(df), truncated=truncated)
+    return answer
+
+def answer_question(audio, record):
+    """
+    Run one question through the chat turn pipeline and return its answer record.
+    The spans of the audio.py functions it calls are recorded in the question's own trace.
+    """
+    trace = audio.TurnTrace()
+    answer = {'id': record['id'], 'question': record.get('question'), 'turn_id': trace.turn_id, 'error': None}
+    try:
+        audio.run_in_trace(trace, answer_turn, audio, trace, record, answer)
+    except Exception as e:
+        answer['error'] = f"{type(e).__name__}: {e}"
+    spans = trace.close()
+    timings = {}
+    for span in spans:
+        timings[span['phase']] = round(timings.get(span['phase'], 0.0) + span['duration_s'], 4)
+    answer['timings'] = timings
+    return answer
+
+def answer_turn(audio, trace, record, answer):
+    """
+    Fill answer with the chat turn of one question, as main() in audio.py runs it
+    """
+    question = record['question']
+    history = record.get('history') or []
+    member_name, member_id = record.get('member_name'), record.get('member_id')
+    if not member_name and record.get('phone_number'):
+        with trace.span('member_lookup'):
+            member_id, member_name = audio.get_member_details(record['phone_number'])[:2]
+    answer['member_name'] = member_name
+    # a question about a known member is restricted to it, like the app's "restricted member" toggle
+    member = (member_name, member_id or '') if member_name else None
+    restriction_prompt = f"This request is related to the member name {member_name}" if member_name else ""
+
+    question_summary = question
+    if history:
+        with trace.span('summarize_question'):
+            question_summary = audio.summarize_question_with_history(history, question, restriction_prompt)
+            question_summary = question_summary.replace("or supporting documentation", "")
+    search_question = f"{question_summary} .{restriction_prompt}"
+
+    intent, search_results = record.get('intent'), None
+    if intent is None:
+        with trace.span('fan_out'):
+            is_violation, intent, search_results = audio.run_turn_fan_out(
+                question_summary, search_question, member, restriction_prompt
+            )
+    else:
+        # the fan-out only checks for violations with intent routing on
+        is_violation = audio.intent_routing and audio.find_violation(question_summary, member, restriction_prompt)
+    answer.update(question_summary=question_summary, intent=intent, violation=is_violation)
+    if is_violation:
+        answer['answer'] = (
+            f"Identified a security violation. Please ensure your question is related to the selected member "
+            f"{member_id} | {member_name}. Please refine the question."
+        )
+        return
+
+    if intent == 'data':
+        answer.update(answer_analyst(audio, trace, question_summary, restriction_prompt))
+    else:
+        if search_results is None:
+            with trace.span('search'):
+                if intent == 'recordings':
+                    search_results = audio.get_similar_transcripts_cortex_search(search_question)
+                else:
+                    search_results = audio.get_similar_chunks_cortex_search(search_question)
+        with trace.span('answer'):
+            response, df_document_urls = audio.complete(search_question, history, intent, search_results, restriction_prompt)
+        answer['answer'] = response
+        answer['documents'] = df_document_urls.drop(columns=['URL_LINK'], errors='ignore').to_dict('records')
+
+def run(audio, records, output, concurrency, rate):
+    """
+    Answer records with up to concurrency questions in flight, writing the answers to output
+    in input order; returns the answers without their text
+    """
+    limiter = RateLimiter(rate)
+
+    def worker(record):
+        limiter.wait()
+        return answer_question(audio, record)
+
+    summaries = []
+    with ThreadPoolExecutor(max_workers=concurrency, thread_name_prefix='batch') as executor:
+        for answer in executor.map(worker, records):
+            output.write(json.dumps(answer, default=str) + "\n")
+            output.flush()
+            summaries.append({'id': answer['id'], 'error': answer['error'], 'seconds': answer['timings']['turn']})
+            print(f"{len(summaries)} answered ({answer['id']}: {answer['timings']['turn']:.2f}s"
+                  f"{', ' + answer['error'] if answer['error'] else ''})", file=sys.stderr)
+    return summaries
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog="python -m batch", description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("questions", help="JSONL file of questions")
+    parser.add_argument("--output", help="JSONL file the answers are written to (default: stdout)")
+    parser.add_argument("--concurrency", type=int, default=4, help="questions answered at the same time")
+    parser.add_argument("--rate", type=float, default=0.0, help="maximum questions started per second (0: unlimited)")
+    parser.add_argument("--model", default='claude-3-5-sonnet')
+    parser.add_argument("--complete-type", default='API', choices=['API', 'SQL'], help="Cortex Complete REST API or SQL function")
+    parser.add_argument("--connection", help="connection name in connections.toml (default connection otherwise)")
+    parser.add_argument("--stubs", action="store_true", help="run against the in-process stand-ins of bench.stubs")
+    if '--stubs' in (sys.argv[1:] if argv is None else argv):
+        from bench import stubs
+        for field in dataclasses.fields(stubs.StubConfig):
+            parser.add_argument(f"--{field.name.replace('_', '-')}", type=field.type, default=field.default)
+    args = parser.parse_args(argv)
+
+    audio = load_app(args)
+    records = list(read_questions(args.questions))
+    start = time.perf_counter()
+    output = open(args.output, "w") if args.output else sys.stdout
+    try:
+        summaries = run(audio, records, output, args.concurrency, args.rate)
+    finally:
+        if args.output:
+            output.close()
+    elapsed = time.perf_counter() - start
+
+    failed = [summary['id'] for summary in summaries if summary['error']]
+    seconds = sorted(summary['seconds'] for summary in summaries) or [0.0]
+    print(
+        f"{len(summaries)} questions in {elapsed:.1f}s, {len(failed)} failed | "
+        f"median {statistics.median(seconds):.2f}s, p95 {seconds[min(len(seconds) - 1, int(0.95 * len(seconds)))]:.2f}s per question",
+        file=sys.stderr
+    )
+    return 1 if failed else 0
@@ -0,0 +1,10 @@
+"""
+Offline micro-benchmarks for the chat turn hot path of audio.py.
+
+The stand-ins in bench.stubs replace Snowpark, Cortex Search, Cortex Complete and
+_snowflake in-process, so the benchmarks run without a Snowflake account:
+
+    cd streamlit
+    python -m bench --output bench_results.json
+    python -m bench --compare bench_results.json
+"""
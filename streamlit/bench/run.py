@@ -0,0 +1,196 @@
+"""
+Time each stage of a chat turn in audio.py against the stand-ins and write the results as JSON.
+Results from two commits can be compared with --compare.
+"""
+import argparse
+import dataclasses
+import json
+import logging
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+from bench import stubs
+
+def git_commit():
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True,
+            cwd=os.path.dirname(os.path.abspath(__file__)), check=True
+        ).stdout.strip()
+    except Exception:
+        return None
+
+def load_app(config):
+    """
+    Install the stand-ins, import audio.py and prime the session state a chat turn expects
+    """
+    stubs.install(config)
+    logging.disable(logging.WARNING)  # silence the bare-mode (no `streamlit run`) warnings
+    sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    import audio
+    import streamlit as st
+    st.session_state.update(
+        messages=[], use_chat_history=True, summarize_with_chat_history=True, cortex_search=True,
+        debug=False, debug_prompt=False, model_name='claude-3-5-sonnet', cortex_complete_type='API',
+        call_summary_context=audio.call_summary_context,
+        restriction_prompt='', restricted_member=False, member_name='', member_id='', turn_timings=[],
+        message_references={}, message_results={}, conversation_memory=audio.ConversationMemory(),
+    )
+    return audio, st
+
+COLD_IMPORT = """
+import json, logging, sys, time
+sys.path.insert(0, {app_dir!r})
+from bench import stubs
+stubs.install()
+logging.disable(logging.WARNING)
+import streamlit  # already loaded by the Streamlit runtime when the app script starts
+start = time.perf_counter()
+import audio
+print(json.dumps({{'import_audio_ms': (time.perf_counter() - start) * 1000, 'module_imports_ms': audio.import_time * 1000}}))
+"""
+
+def time_cold_import(runs):
+    """
+    Import audio.py in fresh interpreters; returns the timings of the whole import
+    (module body included) and of its import block, in milliseconds
+    """
+    app_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    timings = {'import_audio_ms': [], 'module_imports_ms': []}
+    for _ in range(runs):
+        output = subprocess.run(
+            [sys.executable, "-c", COLD_IMPORT.format(app_dir=app_dir)], capture_output=True, text=True, check=True
+        ).stdout
+        for name, value in json.loads(output.strip().splitlines()[-1]).items():
+            timings[name].append(value)
+    return timings
+
+def chat_history(turns, chars):
+    return [
+        {"role": role, "content": stubs.filler_text(chars, seed=i)}
+        for i in range(turns) for role in ("user", "assistant")
+    ]
+
+def time_stage(fn, iterations, warmup):
+    """
+    Call fn(i) warmup + iterations times; returns the timings of the measured calls in milliseconds
+    """
+    for i in range(warmup):
+        fn(-1 - i)
+    timings = []
+    for i in range(iterations):
+        start = time.perf_counter()
+        fn(i)
+        timings.append((time.perf_counter() - start) * 1000)
+    return timings
+
+def summarize(timings):
+    ordered = sorted(timings)
+    return {
+        'n': len(ordered),
+        'mean_ms': round(statistics.fmean(ordered), 4),
+        'median_ms': round(statistics.median(ordered), 4),
+        'p95_ms': round(ordered[min(len(ordered) - 1, int(0.95 * len(ordered)))], 4),
+        'min_ms': round(ordered[0], 4),
+    }
+
+def run(config, iterations, warmup, history_turns, history_chars, import_runs):
+    cold_import = time_cold_import(import_runs) if import_runs else {}
+    audio, st = load_app(config)
+    st.session_state.messages = chat_history(history_turns, history_chars)
+    # local search indexes are built synchronously into a fresh directory, so every run searches the same index
+    audio.local_search_dir = tempfile.mkdtemp(prefix="bench_search_")
+    local_search = audio.get_local_search("CALL_CENTER_RECORDING_SEGMENT_SEARCH")
+    start = time.perf_counter()
+    local_index = local_search.refresh(wait=True)
+    local_search_build = [(time.perf_counter() - start) * 1000]
+    audio.get_local_search("CALL_CENTER_FAQ_SEARCH").refresh(wait=True)
+    history = audio.get_chat_history()
+    question = "What did the member say about the delayed claim and the provider network?"
+
+    # Questions are made unique per call so the prompt and search caches do not hide the work
+    raw_hits = audio.search_cortex(
+        "CALL_CENTER_RECORDING_SEGMENT_SEARCH", question, audio.num_segments, audio.search_return_scores,
+        ('CHUNK', 'RELATIVE_PATH', 'START_SECONDS', 'END_SECONDS')
+    )
+    search_results = audio.get_similar_transcripts_cortex_search(question)
+    analyst_content = json.loads(stubs.send_snow_api_request("POST", "", {}, {}, {}, {}, 0)["content"])["message"]["content"]
+
+    def analyst_content_for(i):
+        # a distinct statement per call, so the result set cache does not answer it
+        return [{**item, "statement": f"{item['statement']} /* {i} */"} if item["type"] == "sql" else item
+                for item in analyst_content]
+
+    stages = {
+        'get_chat_history': lambda i: audio.get_chat_history(),
+        'summarize_question_with_history': lambda i: audio.summarize_question_with_history(history, f"{question} {i}"),
+        'local_search': lambda i: local_index.search(f"{question} {i}", audio.num_segments, ('CHUNK', 'RELATIVE_PATH')),
+        'search_post_processing': lambda i: audio.select_relevant_hits(raw_hits, audio.max_referenced_recordings),
+        'get_similar_transcripts_cortex_search': lambda i: audio.get_similar_transcripts_cortex_search(f"{question} {i}"),
+        'create_prompt': lambda i: audio.create_prompt(question, history, 'recordings', search_results),
+        'display_content_new': lambda i: audio.display_content_new(analyst_content_for(i), f"{question} {i}"),
+        'display_content_new_cached_result': lambda i: audio.display_content_new(analyst_content, f"{question} {i}"),
+    }
+    results = {f"cold_{name}": summarize(timings) for name, timings in cold_import.items()}
+    results['local_search_build'] = summarize(local_search_build)
+    results.update((name, summarize(time_stage(fn, iterations, warmup))) for name, fn in stages.items())
+    return {
+        'commit': git_commit(),
+        'timestamp': time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'iterations': iterations,
+        'history': {'turns': history_turns, 'chars': history_chars},
+        'config': dataclasses.asdict(config),
+        'stages': results,
+    }
+
+def compare(current, baseline, tolerance):
+    """
+    Print the median change of every stage against a baseline run; returns the regressed stages
+    """
+    print(f"{'stage':40} {'baseline':>12} {'current':>12} {'change':>8}")
+    regressed = []
+    for name, stats in current['stages'].items():
+        before = baseline['stages'].get(name)
+        if before is None:
+            print(f"{name:40} {'-':>12} {stats['median_ms']:>10.3f}ms")
+            continue
+        change = stats['median_ms'] / before['median_ms'] - 1 if before['median_ms'] else 0.0
+        flag = " REGRESSION" if change > tolerance else ""
+        print(f"{name:40} {before['median_ms']:>10.3f}ms {stats['median_ms']:>10.3f}ms {change:>+7.1%}{flag}")
+        if flag:
+            regressed.append(name)
+    return regressed
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog="python -m bench", description=__doc__)
+    parser.add_argument("--iterations", type=int, default=50)
+    parser.add_argument("--warmup", type=int, default=3)
+    parser.add_argument("--history-turns", type=int, default=3, help="question/answer pairs in the chat history")
+    parser.add_argument("--history-chars", type=int, default=1500, help="characters per chat message")
+    parser.add_argument("--import-runs", type=int, default=5, help="fresh interpreters timing the import of audio.py")
+    parser.add_argument("--output", help="write the results to this JSON file")
+    parser.add_argument("--compare", help="baseline JSON file to compare the median timings against")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="median slowdown reported as a regression")
+    for field in dataclasses.fields(stubs.StubConfig):
+        parser.add_argument(f"--{field.name.replace('_', '-')}", type=field.type, default=field.default)
+    args = parser.parse_args(argv)
+
+    config = stubs.StubConfig(**{field.name: getattr(args, field.name) for field in dataclasses.fields(stubs.StubConfig)})
+    results = run(config, args.iterations, args.warmup, args.history_turns, args.history_chars, args.import_runs)
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+    if args.compare:
+        with open(args.compare) as f:
+            regressed = compare(results, json.load(f), args.tolerance)
+        return 1 if regressed else 0
+    print(json.dumps(results['stages'], indent=2))
+    return 0
@@ -0,0 +1,246 @@
+"""
+In-process stand-ins for the Snowflake clients used by audio.py, with configurable
+latency and payload sizes. install() must run before audio.py is imported.
+"""
+import json
+import sys
+import time
+import types
+from dataclasses import dataclass
+
+WORDS = (
+    "member called about claim status provider network coverage deductible copay "
+    "referral prescription pharmacy grievance appeal benefit plan premium address"
+).split()
+
+@dataclass
+class StubConfig:
+    complete_latency: float = 0.0 # seconds per Cortex Complete call
+    search_latency: float = 0.0 # seconds per Cortex Search query
+    sql_latency: float = 0.0 # seconds per session.sql(...).collect()
+    analyst_latency: float = 0.0 # seconds per Cortex Analyst request
+    stage_files: int = 200 # files listed in each stage folder
+    chunk_chars: int = 4000 # characters per search hit
+    response_chars: int = 400 # characters per Complete response
+    stream_chunk_chars: int = 20 # characters per streamed Complete chunk
+    result_rows: int = 100 # rows returned by a Cortex Analyst SQL statement
+    result_columns: int = 8 # columns of those rows
+    batch_rows: int = 1000 # rows per to_pandas_batches() batch
+    summary_chars: int = 500 # characters per precomputed call summary
+    segments_per_file: int = 10 # rows per recording / FAQ document in the tables the search services index
+    segment_chars: int = 400 # characters per segment or FAQ chunk in those tables
+
+CONFIG = StubConfig()
+
+def filler_text(chars, seed=0):
+    """
+    Deterministic sentence-like text of about chars characters
+    """
+    words, size, i = [], 0, seed
+    while size < chars:
+        word = WORDS[i % len(WORDS)]
+        if i % 12 == 11:
+            word += "."
+        words.append(word)
+        size += len(word) + 1
+        i += 7
+    return " ".join(words)[:chars]
+
+class Row(dict):
+    """
+    Snowpark Row stand-in: attribute and key access
+    """
+    def __getattr__(self, name):
+        try:
+            return self[name]
+        except KeyError:
+            raise AttributeError(name)
+
+class StubDataFrame:
+    def __init__(self, rows):
+        self.rows = rows
+
+    def collect(self):
+        time.sleep(CONFIG.sql_latency)
+        return self.rows
+
+    def to_pandas(self):
+        import pandas as pd
+        time.sleep(CONFIG.sql_latency)
+        return pd.DataFrame(self.rows)
+
+    def to_pandas_batches(self):
+        import pandas as pd
+        time.sleep(CONFIG.sql_latency)
+        for start in range(0, len(self.rows), CONFIG.batch_rows):
+            yield pd.DataFrame(self.rows[start:start + CONFIG.batch_rows])
+
+def stage_files(folder):
+    extension = "mp3" if folder.upper() == "CALL_RECORDINGS" else "pdf"
+    return [
+        Row(RELATIVE_PATH=f"{folder}/file_{i}.{extension}", SIZE=1000 + i, MD5=f"{i:032x}", MODIFIED_MS=1000 + i)
+        for i in range(CONFIG.stage_files)
+    ]
+
+class StubSession:
+    """
+    Snowpark Session stand-in answering the statements audio.py issues
+    """
+    query_tag = None
+
+    def get_current_database(self):
+        return "BENCH_DB"
+
+    def get_current_schema(self):
+        return "BENCH_SCHEMA"
+
+    def sql(self, cmd, params=None):
+        text = cmd.lower()
+        if "get_presigned_url" in text:
+            return StubDataFrame([Row(RELATIVE_PATH=p, URL_LINK=f"https://stage.invalid/{p}") for p in params or []])
+        if "directory(" in text:
+            folder = "FAQ" if "faq" in text else "CALL_RECORDINGS"
+            since = params[0] if params else -1
+            return StubDataFrame([row for row in stage_files(folder) if row.MODIFIED_MS >= since])
+        if "information_schema.tables" in text:
+            rows = CONFIG.stage_files * CONFIG.segments_per_file
+            return StubDataFrame([Row(TABLE_NAME=name, ALTERED_MS=1000, ROW_COUNT=rows) for name in params[1:]])
+        if "call_recordings_segments" in text or "call_recordings_transcript_table_tx" in text or "faq_docs_chunks_table" in text:
+            return StubDataFrame(search_documents(text))
+        if "call_recordings_summary_table" in text:
+            return StubDataFrame([call_summary(name) for name in params or []])
+        if "call_center_member_denormalized_with_intent" in text:
+            return StubDataFrame([row for row in member_rows() if row.MEMBER_PHONE in (params or [])])
+        if "call_center_member_lookup" in text:
+            since = params[0] if params else -1
+            return StubDataFrame([row for row in member_rows() if row.UPDATED_MS > since])
+        if "cortex.complete" in text:
+            return StubDataFrame([Row(RESPONSE=complete_response(params[1] if params else cmd))])
+        return StubDataFrame([
+            Row({f"COLUMN_{c}": r * c if c % 2 else f"value {r}-{c}" for c in range(CONFIG.result_columns)})
+            for r in range(CONFIG.result_rows)
+        ])
+
+def search_documents(text):
+    """
+    Rows of the table a search service indexes: segments_per_file timestamped segments per
+    recording, one transcript per recording, or segments_per_file chunks per FAQ document
+    """
+    if "faq_docs_chunks_table" in text:
+        return [Row(CHUNK=filler_text(CONFIG.segment_chars, seed=i * 7 + j), RELATIVE_PATH=row.RELATIVE_PATH)
+                for i, row in enumerate(stage_files("FAQ")) for j in range(CONFIG.segments_per_file)]
+    if "call_recordings_transcript_table_tx" in text:
+        return [Row(CHUNK=filler_text(CONFIG.chunk_chars, seed=i), RELATIVE_PATH=row.RELATIVE_PATH)
+                for i, row in enumerate(stage_files("CALL_RECORDINGS"))]
+    return [
+        Row(CHUNK=filler_text(CONFIG.segment_chars, seed=i * 7 + j), RELATIVE_PATH=row.RELATIVE_PATH,
+            START_SECONDS=30.0 * j, END_SECONDS=30.0 * (j + 1))
+        for i, row in enumerate(stage_files("CALL_RECORDINGS")) for j in range(CONFIG.segments_per_file)
+    ]
+
+def call_summary(audio_file_name):
+    return Row(
+        AUDIO_FILE_NAME=audio_file_name, SUMMARY=filler_text(CONFIG.summary_chars, seed=len(audio_file_name)),
+        CALL_REASON="Claim status", SENTIMENT=-0.25, CLAIM_IDS='["CLM-1001"]', MEMBER_IDS='["M0001"]', PROVIDERS='[]'
+    )
+
+def member_rows():
+    return [
+        Row(MEMBER_PHONE=f"555-01{i:02d}", MEMBER_ID=f"M{i:04d}", NAME=f"Member {i}",
+            POTENTIAL_CALLER_INTENT="Claim status", ADDITIONAL_INFO="", UPDATED_MS=1000 + i)
+        for i in range(CONFIG.stage_files)
+    ]
+
+def complete_response(prompt):
+    return filler_text(CONFIG.response_chars, seed=len(prompt))
+
+def Complete(model, prompt, session=None, stream=False):
+    """
+    snowflake.cortex.Complete stand-in
+    """
+    time.sleep(CONFIG.complete_latency)
+    response = complete_response(prompt)
+    if not stream:
+        return response
+    step = CONFIG.stream_chunk_chars
+    return iter([response[i:i + step] for i in range(0, len(response), step)])
+
+class StubSearchResponse:
+    def __init__(self, results):
+        self.results = results
+
+class StubSearchService:
+    """
+    Cortex Search service stand-in: limit hits of chunk_chars characters over the
+    recordings (or FAQ documents) of the stub stage, with decreasing scores
+    """
+    def __init__(self, name):
+        self.folder = "FAQ" if "FAQ" in name else "CALL_RECORDINGS"
+
+    def search(self, query, columns, limit, **options):
+        time.sleep(CONFIG.search_latency)
+        extension = "mp3" if self.folder == "CALL_RECORDINGS" else "pdf"
+        results = []
+        for i in range(limit):
+            hit = {
+                'CHUNK': filler_text(CONFIG.chunk_chars, seed=i),
+                'RELATIVE_PATH': f"{self.folder.lower()}/file_{i % 5}.{extension}",
+                'START_SECONDS': 30.0 * i,
+                'END_SECONDS': 30.0 * (i + 1),
+                '@scores': {'cosine_similarity': 1.0 - i / (2 * limit)},
+            }
+            results.append({k: v for k, v in hit.items() if k in columns or k.startswith('@')})
+        return StubSearchResponse(results)
+
+class AutoDict(dict):
+    def __init__(self, factory):
+        super().__init__()
+        self.factory = factory
+
+    def __missing__(self, key):
+        value = self[key] = self.factory(key)
+        return value
+
+class Root:
+    """
+    snowflake.core.Root stand-in exposing databases[..].schemas[..].cortex_search_services[..]
+    """
+    def __init__(self, session):
+        self.databases = AutoDict(lambda _: types.SimpleNamespace(
+            schemas=AutoDict(lambda _: types.SimpleNamespace(cortex_search_services=AutoDict(StubSearchService)))
+        ))
+
+def send_snow_api_request(method, path, headers, params, body, request_guid, timeout):
+    """
+    _snowflake.send_snow_api_request stand-in returning a Cortex Analyst answer with SQL
+    """
+    time.sleep(CONFIG.analyst_latency)
+    content = [
+        {"type": "text", "text": "This is our interpretation of your question."},
+        {"type": "sql", "statement": "SELECT * FROM CALL_CENTER_MEMBER_DENORMALIZED LIMIT 100"},
+    ]
+    return {"status": 200, "content": json.dumps({"message": {"role": "analyst", "content": content}})}
+
+SESSION = StubSession()
+
+def module(name, **attributes):
+    mod = types.ModuleType(name)
+    mod.__path__ = []
+    mod.__dict__.update(attributes)
+    sys.modules[name] = mod
+    return mod
+
+def install(config=None):
+    """
+    Register the stand-ins as the snowflake and _snowflake modules and apply config
+    """
+    if config is not None:
+        CONFIG.__dict__.update(config.__dict__)
+    snowflake = module("snowflake")
+    snowflake.snowpark = module("snowflake.snowpark", Session=StubSession)
+    snowflake.snowpark.context = module("snowflake.snowpark.context", get_active_session=lambda: SESSION)
+    snowflake.cortex = module("snowflake.cortex", Complete=Complete)
+    snowflake.core = module("snowflake.core", Root=Root)
+    snowflake.connector = module("snowflake.connector")
+    module("_snowflake", send_snow_api_request=send_snow_api_request)
+    return CONFIG
@@ -0,0 +1,17 @@
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from bench import stubs
+from bench.run import load_app
+
+@pytest.fixture(scope="session")
+def audio():
+    """
+    audio.py imported against the in-process Snowflake stand-ins of bench.stubs
+    """
+    app, _ = load_app(stubs.StubConfig())
+    return app
@@ -0,0 +1,32 @@
+import json
+import time
+
+from batch.run import main
+
+def test_batch_answers_in_input_order_at_the_requested_rate(audio, tmp_path):
+    questions = tmp_path / "questions.jsonl"
+    answers = tmp_path / "answers.jsonl"
+    records = [
+        {'id': 'faq', 'question': "How do I appeal a denied claim?", 'intent': 'faq'},
+        {'question': "What did the member say about the delayed claim?", 'member_name': "Jane Doe", 'member_id': "M1"},
+        {'id': 'data', 'question': "How many calls were about claim status?", 'intent': 'data'},
+        {'id': 'history', 'question': "And the provider network?", 'intent': 'recordings',
+         'history': [{'role': 'user', 'content': "What did the member say about the delayed claim?"},
+                     {'role': 'assistant', 'content': "The claim was delayed by a missing form."}]},
+    ]
+    questions.write_text("".join(json.dumps(record) + "\n" for record in records))
+
+    rate = 10.0
+    start = time.perf_counter()
+    assert main([str(questions), "--stubs", "--concurrency", "4", "--rate", str(rate), "--output", str(answers)]) == 0
+    elapsed = time.perf_counter() - start
+
+    results = [json.loads(line) for line in answers.read_text().splitlines()]
+    assert [result['id'] for result in results] == ['faq', 2, 'data', 'history']
+    assert all(result['error'] is None and result['answer'] for result in results)
+    assert results[1]['member_name'] == "Jane Doe"
+    assert results[2]['sql'] and results[2]['rows'] > 0
+    # the question starts are spaced 1 / rate seconds apart across the workers
+    assert elapsed >= (len(records) - 1) / rate
+    # the spans of the audio.py functions land on each question's own trace
+    assert all(result['timings']['cortex_complete'] > 0 for result in results)
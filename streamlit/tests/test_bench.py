@@ -0,0 +1,17 @@
+import json
+
+from bench.run import main
+
+def test_bench_writes_json_results(audio, tmp_path):
+    output = tmp_path / "results.json"
+    assert main(["--iterations", "2", "--warmup", "0", "--import-runs", "1", "--output", str(output)]) == 0
+
+    results = json.loads(output.read_text())
+    assert results['iterations'] == 2
+    for stage in ('get_chat_history', 'search_post_processing', 'create_prompt', 'display_content_new'):
+        assert results['stages'][stage]['n'] == 2
+        assert results['stages'][stage]['median_ms'] >= 0.0
+    assert results['stages']['cold_import_audio_ms']['n'] == 1
+
+    # the same results compared against themselves show no regression
+    assert main(["--iterations", "2", "--warmup", "0", "--import-runs", "1", "--compare", str(output), "--tolerance", "100"]) == 0
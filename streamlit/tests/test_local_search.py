@@ -0,0 +1,88 @@
+import math
+
+import numpy as np
+import pandas as pd
+
+DOCUMENTS = pd.DataFrame({
+    'CHUNK': [
+        "claim denied claim appeal",
+        "pharmacy refill question",
+        "claim status pending",
+        "provider network claim claim claim question",
+        None,
+    ],
+    'RELATIVE_PATH': ['a.mp3', 'b.mp3', 'c.mp3', 'd.mp3', 'e.mp3'],
+    'START_SECONDS': [0.0, 30.0, 60.0, 90.0, 120.0],
+})
+
+def build(audio, tmp_path, documents=DOCUMENTS, batch_rows=2):
+    tmp_path.mkdir(exist_ok=True)
+    directory = str(tmp_path / "index")
+    batches = [documents.iloc[start:start + batch_rows] for start in range(0, len(documents), batch_rows)]
+    audio.HybridIndex.build(directory, batches, 1234, 64)
+    return audio.HybridIndex(directory)
+
+def bm25(query, texts, k1=1.2, b=0.75):
+    """
+    Textbook BM25 over whitespace-separated texts
+    """
+    docs = [text.split() if isinstance(text, str) else [] for text in texts]
+    average_length = sum(len(doc) for doc in docs) / len(docs)
+    scores = []
+    for doc in docs:
+        score = 0.0
+        for term in query.split():
+            df = sum(term in other for other in docs)
+            tf = doc.count(term)
+            idf = math.log(1.0 + (len(docs) - df + 0.5) / (df + 0.5))
+            score += idf * tf * (k1 + 1.0) / (tf + k1 * (1.0 - b + b * len(doc) / average_length))
+        scores.append(score)
+    return scores
+
+def test_build_reopens_memory_mapped(audio, tmp_path):
+    index = build(audio, tmp_path)
+    assert index.version == 1234
+    assert index.meta['documents'] == len(DOCUMENTS)
+    assert isinstance(index.embeddings, np.memmap)
+    assert isinstance(index.posting_docs, np.memmap)
+    assert index.embeddings.shape == (len(DOCUMENTS), 64)
+    assert [index.value('RELATIVE_PATH', doc) for doc in range(len(DOCUMENTS))] == list(DOCUMENTS['RELATIVE_PATH'])
+    assert index.value('CHUNK', 4) == ""
+    assert index.value('START_SECONDS', 3) == 90.0
+
+def test_top_k_follows_hand_computed_bm25(audio, tmp_path, monkeypatch):
+    monkeypatch.setattr(audio, 'local_search_alpha', 1.0)  # rank on BM25 alone
+    index = build(audio, tmp_path)
+    for query in ("claim", "claim question", "pharmacy question"):
+        scores = bm25(query, DOCUMENTS['CHUNK'])
+        expected = sorted(range(len(scores)), key=lambda doc: (-scores[doc], doc))[:3]
+        hits = index.search(query, 3, ('RELATIVE_PATH',))
+        assert list(hits['RELATIVE_PATH']) == [DOCUMENTS['RELATIVE_PATH'][doc] for doc in expected]
+
+def test_search_is_deterministic_across_builds(audio, tmp_path):
+    first = build(audio, tmp_path / "first").search("claim appeal question", 4, ('CHUNK', 'RELATIVE_PATH'))
+    second = build(audio, tmp_path / "second", batch_rows=5).search("claim appeal question", 4, ('CHUNK', 'RELATIVE_PATH'))
+    pd.testing.assert_frame_equal(first, second)
+    assert first['SCORE'].between(0.0, 1.0).all()
+
+def test_low_confidence_falls_back_to_cortex_search(audio, tmp_path, monkeypatch):
+    monkeypatch.setattr(audio, 'local_search', True)
+    monkeypatch.setattr(audio, 'local_search_dir', str(tmp_path))
+    local_search = audio.LocalSearch("CALL_CENTER_FAQ_SEARCH")
+    assert local_search.refresh(wait=True) is not None
+    monkeypatch.setattr(audio, 'get_local_search', lambda service_name: local_search)
+    search = audio.search_cortex
+
+    # every term is in the stand-in FAQ chunks: answered locally
+    question = "member called about claim status"
+    assert local_search.search(question, 5, ('CHUNK', 'RELATIVE_PATH')) is not None
+    local_hits = search("CALL_CENTER_FAQ_SEARCH", question, 5)
+    assert local_hits['SCORE'].iloc[0] >= audio.local_search_min_score
+    assert local_hits['RELATIVE_PATH'].str.startswith("FAQ/").all()
+
+    # no term is: the best local hit scores below local_search_min_score and Cortex Search answers
+    question = "zebra xylophone"
+    assert local_search.refresh().search(question, 5)['SCORE'].iloc[0] < audio.local_search_min_score
+    assert local_search.search(question, 5, ('CHUNK', 'RELATIVE_PATH')) is None
+    remote_hits = search("CALL_CENTER_FAQ_SEARCH", question, 5)
+    assert remote_hits['RELATIVE_PATH'].str.startswith("faq/").all()